@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CPU на получение аудио: перекодирование в MP3 против копирования дорожки.
+
+Создаёт тестовый mp4 (H.264 + AAC) заданной длины и сравнивает процессорное
+время ffmpeg (RUSAGE_CHILDREN) для:
+- режима «всё»: extract_audio в MP3 192 кбит/с (старый путь) и с -c copy в m4a;
+- режима «аудио»: постпроцессор yt-dlp FFmpegExtractAudio в mp3 и в m4a.
+
+    python bench/bench_audio.py --seconds 240 --runs 3
+
+Нужен ffmpeg.
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def make_source(path, seconds):
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'testsrc2=size=320x180:rate=15',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+        '-t', str(seconds), '-c:v', 'libx264', '-preset', 'ultrafast',
+        '-c:a', 'aac', '-b:a', '128k', path,
+    ], check=True)
+
+
+def measure(func, runs):
+    """Медианные CPU и время одного запуска func()"""
+    cpu, wall = [], []
+    for _ in range(runs):
+        cpu_before, started = children_cpu(), time.perf_counter()
+        func()
+        cpu.append(children_cpu() - cpu_before)
+        wall.append(time.perf_counter() - started)
+    return sorted(cpu)[len(cpu) // 2], sorted(wall)[len(wall) // 2]
+
+
+def extract_mp3(source, workdir):
+    dst = os.path.join(workdir, 'audio.mp3')
+    ok = asyncio.run(bot.run_ffmpeg(
+        source, dst, '-vn', '-codec:a', 'libmp3lame', '-b:a', f"{bot.AUDIO_QUALITY}k"
+    ))
+    assert ok
+
+
+def extract_copy(source, workdir):
+    dst = os.path.join(workdir, 'audio.m4a')
+    ok = asyncio.run(bot.run_ffmpeg(source, dst, '-vn', '-codec:a', 'copy'))
+    assert ok
+
+
+def postprocess(source, workdir, codec):
+    from yt_dlp import YoutubeDL
+    from yt_dlp.postprocessor import FFmpegExtractAudioPP
+
+    path = os.path.join(workdir, 'track.mp4')
+    shutil.copyfile(source, path)
+    with YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
+        pp = FFmpegExtractAudioPP(ydl, preferredcodec=codec, preferredquality=bot.AUDIO_QUALITY)
+        pp.run({'filepath': path, 'ext': 'mp4', 'vcodec': 'h264', 'acodec': 'mp4a.40.2'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=int, default=240, help="длина тестового трека")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    if not shutil.which('ffmpeg'):
+        raise SystemExit("Нужен ffmpeg")
+
+    workdir = tempfile.mkdtemp(prefix="hartidash_bench_")
+    try:
+        source = os.path.join(workdir, 'source.mp4')
+        make_source(source, args.seconds)
+        cases = [
+            ("all: mp3 192k (было)", lambda: extract_mp3(source, workdir)),
+            ("all: copy -> m4a", lambda: extract_copy(source, workdir)),
+            ("audio: yt-dlp -> mp3", lambda: postprocess(source, workdir, 'mp3')),
+            ("audio: yt-dlp -> m4a", lambda: postprocess(source, workdir, 'm4a')),
+        ]
+        print(f"track: {args.seconds} s\n")
+        print(f"{'path':>24} {'CPU, s':>8} {'wall, s':>8}")
+        for name, func in cases:
+            cpu, wall = measure(func, args.runs)
+            print(f"{name:>24} {cpu:>8.2f} {wall:>8.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест очереди скачиваний.
+
+Запускает пачку имитированных скачиваний от разных пользователей тем же путём,
+что и бот: слот DownloadPool.slot, затем YtdlpProcessPool.run. Процессы yt-dlp
+заменены заглушкой, которая отвечает по тому же протоколу: шлёт progress
+каждые --progress-interval секунд и через --job-time секунд завершает задачу.
+Меряет пропускную способность при разном числе воркеров (DOWNLOAD_WORKERS и
+DOWNLOAD_PROCESSES равны), самое долгое ожидание слота и задержку event loop,
+пока в нём идут хуки прогресса.
+
+    python bench/bench_concurrency.py --jobs 32 --job-time 0.2 --workers 1 2 4 8
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+
+class FakeYtdlpProcess:
+    """Заглушка процесса ytdlp_worker.py: тот же протокол, вместо yt-dlp - пауза"""
+
+    def __init__(self, job_time, progress_interval):
+        self.job_time = job_time
+        self.progress_interval = progress_interval
+        self.alive = True
+        self._request = None
+        self._deadline = None
+
+    async def send(self, request):
+        self._request = request
+        self._deadline = time.monotonic() + self.job_time
+
+    async def read(self):
+        left = self._deadline - time.monotonic()
+        if left > self.progress_interval:
+            await asyncio.sleep(self.progress_interval)
+            return {'id': self._request['id'], 'event': 'progress',
+                    'data': {'status': 'downloading', 'downloaded_bytes': 0}}
+        await asyncio.sleep(max(left, 0))
+        return {'id': self._request['id'], 'event': 'done', 'result': None}
+
+    def kill(self):
+        self.alive = False
+
+    async def stop(self):
+        self.alive = False
+
+
+class FakeYtdlpProcessPool(bot.YtdlpProcessPool):
+    """Настоящий пул (семафор, переиспользование, хуки) с процессами-заглушками"""
+
+    def __init__(self, size, job_time, progress_interval):
+        super().__init__(size, timeout=60)
+        self.job_time = job_time
+        self.progress_interval = progress_interval
+
+    async def _take(self):
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.alive:
+                return worker
+        return FakeYtdlpProcess(self.job_time, self.progress_interval)
+
+
+async def fast_handler_latency(stop, samples):
+    """Имитирует /start: меряет, насколько поздно просыпается корутина"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        samples.append(time.perf_counter() - started - 0.01)
+
+
+async def run_round(workers, jobs, job_time, users, progress_interval):
+    pool = bot.DownloadPool(workers, per_user=jobs, max_queue=jobs)
+    processes = FakeYtdlpProcessPool(workers, job_time, progress_interval)
+    hooks = [0]
+    waits = []
+
+    def on_progress(d):
+        hooks[0] += 1
+
+    async def job(n):
+        queued = time.perf_counter()
+        async with pool.slot(n % users):
+            waits.append(time.perf_counter() - queued)
+            await processes.run('download', f"https://example.com/{n}.mp4", {}, [on_progress])
+
+    stop = asyncio.Event()
+    samples = []
+    probe = asyncio.create_task(fast_handler_latency(stop, samples))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(job(n) for n in range(jobs)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await probe
+    await processes.close()
+    pool.executor.shutdown(wait=True)
+
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1] if samples else 0.0
+    return jobs / elapsed, elapsed, p99, max(waits), hooks[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=32)
+    parser.add_argument("--job-time", type=float, default=0.2)
+    parser.add_argument("--progress-interval", type=float, default=0.02)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'jobs/s':>10} {'total, s':>10} {'max wait, s':>12} {'hooks':>7} {'loop p99, ms':>14}")
+    for workers in args.workers:
+        rate, elapsed, p99, max_wait, hooks = asyncio.run(
+            run_round(workers, args.jobs, args.job_time, args.users, args.progress_interval)
+        )
+        print(f"{workers:>8} {rate:>10.2f} {elapsed:>10.2f} {max_wait:>12.2f} {hooks:>7} {p99 * 1000:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
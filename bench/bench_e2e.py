@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сквозной офлайн-бенчмарк бота.
+
+Поднимает локальные заглушки Bot API, медиасервера и Яндекс.Диска (bench/fakes.py),
+собирает Application через bot.build_application() с base_url на заглушку и
+прогоняет смесь сообщений (видео/аудио/всё/QR/несколько ссылок сразу,
+файлы меньше и больше MAX_TELEGRAM_SIZE). Печатает p50/p95/p99 задержки обработки, запросов в секунду
+и пиковый RSS. С --save/--baseline сохраняет результат и сравнивает с прошлым,
+завершаясь с ошибкой при регрессии.
+
+    python bench/bench_e2e.py --messages 200 --concurrency 16 --mix video=5,qr=2
+    python bench/bench_e2e.py --save base.json
+    python bench/bench_e2e.py --baseline base.json --tolerance 0.2
+    python bench/bench_e2e.py --local-api --mix video=1 --large-ratio 0.5
+
+С --local-api заглушка изображает свой сервер Bot API в режиме --local: бот
+передаёт файлы путями file://, а большие файлы (до MAX_LOCAL_API_SIZE) идут
+в Telegram, минуя Яндекс.Диск.
+
+С --workers N бот в этом процессе работает как BOT_ROLE=front, а скачивают
+N процессов BOT_ROLE=worker через общую очередь заданий; задержка сообщения -
+до того, как front забрал отчёт воркера.
+
+    python bench/bench_e2e.py --workers 2 --mix video=3,multi=1,qr=1
+
+Режимы audio и all требуют ffmpeg, как и в продакшене.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeServices  # noqa: E402
+
+TOKEN = "123456:bench"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {'video', 'audio', 'all', 'qr', 'multi'}
+    if unknown:
+        raise SystemExit(f"Неизвестные типы сообщений: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+def make_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def build_messages(args, services):
+    """Список (тип, пользователь, текст) по заданной смеси"""
+    rng = random.Random(args.seed)
+    small = services.media.make_video('small.mp4', args.small_mb * 1024 * 1024)
+    large = services.media.make_video('large.mp4', args.large_mb * 1024 * 1024)
+    kinds = list(args.mix)
+    weights = [args.mix[k] for k in kinds]
+
+    messages = []
+    for n in range(args.messages):
+        kind = rng.choices(kinds, weights)[0]
+        # Пользователи разбиты по режимам: режим - настройка пользователя, а не сообщения
+        user_id = 1000 * (kinds.index(kind) + 1) + n % args.users
+        if kind == 'qr':
+            text = f"/qr bench {n}"
+        elif kind == 'multi':
+            # Несколько ссылок в одном сообщении, качаются как видео
+            text = " ".join(f"{services.base_url}/media/small.mp4?n={n}-{k}" for k in range(args.links))
+        else:
+            name = os.path.basename(large if rng.random() < args.large_ratio else small)
+            # Повторы ссылок проверяют кэш и склейку одинаковых скачиваний
+            variant = rng.randrange(max(1, n)) if n and rng.random() < args.repeat_ratio else n
+            text = f"{services.base_url}/media/{name}?n={variant}"
+        messages.append((kind, user_id, text))
+    return messages
+
+
+def start_workers(args, services):
+    """Процессы BOT_ROLE=worker с теми же заглушками Bot API и Яндекс.Диска"""
+    env = dict(
+        os.environ,
+        BOT_ROLE='worker',
+        METRICS_PORT='0',
+        TELEGRAM_API_URL=f"{services.base_url}/bot",
+        TELEGRAM_FILE_URL=f"{services.base_url}/file/bot",
+        TELEGRAM_LOCAL_MODE='1' if args.local_api else '0',
+    )
+    code = (
+        "import runpy, sys, yadisk; yadisk.settings.BASE_API_URL = sys.argv[1]; "
+        "runpy.run_path(sys.argv[2], run_name='__main__')"
+    )
+    return [
+        subprocess.Popen([sys.executable, '-c', code, services.base_url, os.path.join(ROOT, 'bot.py')], env=env)
+        for _ in range(args.workers)
+    ]
+
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        try:
+            worker.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+            worker.wait()
+
+
+async def wait_for_workers(services, count, timeout=60):
+    """Воркер готов, когда сделал getMe (front делает свой до прогона)"""
+    deadline = time.monotonic() + timeout
+    while services.fetch_stats()['bot_api_calls'].get('getMe', 0) < count + 1:
+        if time.monotonic() > deadline:
+            raise SystemExit("Воркеры не запустились")
+        await asyncio.sleep(0.2)
+
+
+def tracking_application_class():
+    """Application, который помнит задачи неблокирующих обработчиков по update_id"""
+    from telegram import Update
+    from telegram.ext import Application
+
+    class TrackingApplication(Application):
+        # Ссылки обрабатываются с block=False: process_update возвращается сразу,
+        # а задержку сообщения меряем до конца задачи обработчика
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.handler_tasks = {}
+
+        def create_task(self, coroutine, update=None, **kwargs):
+            task = super().create_task(coroutine, update=update, **kwargs)
+            if isinstance(update, Update):
+                self.handler_tasks[update.update_id] = task
+            return task
+
+    return TrackingApplication
+
+
+async def replay(bot, app, messages, concurrency):
+    from telegram import Update
+
+    for kind, user_id, _ in messages:
+        if kind != 'qr':
+            bot.user_data.set_preference(user_id, 'video' if kind == 'multi' else kind)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = defaultdict(list)
+
+    # В режиме front сообщение готово, когда front забрал задание из очереди
+    jobs = {}  # update_id -> id задания
+    if bot.BOT_ROLE == 'front':
+        put = bot.job_queue.put
+
+        def tracked_put(user_id, payload):
+            job_id = put(user_id, payload)
+            jobs[payload['update']['update_id']] = job_id
+            return job_id
+
+        bot.job_queue.put = tracked_put
+        queue_db = sqlite3.connect(bot.JOB_QUEUE_DB, check_same_thread=False)
+
+    async def wait_job(job_id):
+        while queue_db.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone():
+            await asyncio.sleep(0.05)
+
+    async def one(update_id, kind, user_id, text):
+        async with semaphore:
+            update = Update.de_json(make_update(update_id, user_id, text), app.bot)
+            started = time.perf_counter()
+            await app.process_update(update)
+            task = app.handler_tasks.pop(update_id, None)
+            if task:
+                await task
+            if update_id in jobs:
+                await wait_job(jobs[update_id])
+            latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n + 1, *message) for n, message in enumerate(messages)))
+    return latencies, time.perf_counter() - started
+
+
+async def run(args, services):
+    import bot
+    from telegram.ext import Application
+
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{services.base_url}/bot")
+        .base_file_url(f"{services.base_url}/file/bot")
+        .local_mode(args.local_api)
+        .application_class(tracking_application_class())
+    )
+    app = bot.build_application(builder)
+    await app.initialize()
+    await bot.on_startup(app)
+    workers = start_workers(args, services) if args.workers else []
+    try:
+        messages = build_messages(args, services)
+        if workers:
+            await wait_for_workers(services, len(workers))
+        latencies, elapsed = await replay(bot, app, messages, args.concurrency)
+    finally:
+        stop_workers(workers)
+        await bot.on_shutdown(app)
+        await app.shutdown()
+    return latencies, elapsed
+
+
+def report(args, latencies, elapsed, stats):
+    total = sum(len(v) for v in latencies.values())
+    result = {
+        'messages': total,
+        'seconds': elapsed,
+        'rps': total / elapsed if elapsed else 0.0,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_cpu_s': resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime,
+        'kinds': {},
+        'bot_api_calls': stats['bot_api_calls'],
+        'telegram_bytes': stats['telegram_bytes'],
+        'yandex_bytes': stats['yandex_bytes'],
+        'local_files': len(stats['local_files']),
+    }
+    everything = [x for samples in latencies.values() for x in samples]
+    for kind, samples in sorted(latencies.items()) + [('all messages', everything)]:
+        result['kinds'][kind] = {
+            'count': len(samples),
+            'p50': percentile(samples, 0.50),
+            'p95': percentile(samples, 0.95),
+            'p99': percentile(samples, 0.99),
+        }
+
+    print(f"\n{'type':>14} {'count':>7} {'p50, s':>9} {'p95, s':>9} {'p99, s':>9}")
+    for kind, row in result['kinds'].items():
+        print(f"{kind:>14} {row['count']:>7} {row['p50']:>9.3f} {row['p95']:>9.3f} {row['p99']:>9.3f}")
+    print(f"\nthroughput: {result['rps']:.2f} msg/s over {elapsed:.1f} s")
+    print(f"peak RSS: {result['peak_rss_mb']:.0f} MB, CPU дочерних процессов: {result['children_cpu_s']:.1f} s")
+    print(f"Bot API calls: {sum(stats['bot_api_calls'].values())} {stats['bot_api_calls']}")
+    print(f"uploaded: Telegram {result['telegram_bytes'] / 1024 ** 2:.1f} MB, "
+          f"Yandex {result['yandex_bytes'] / 1024 ** 2:.1f} MB")
+    if args.local_api:
+        print(f"passed by local path (file://): {result['local_files']} files")
+    return result
+
+
+def compare(result, baseline_path, tolerance):
+    """Сравнивает p95 и пропускную способность с сохранённым прогоном"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for kind, stats in result['kinds'].items():
+        old = baseline['kinds'].get(kind)
+        if old and old['p95'] and stats['p95'] > old['p95'] * (1 + tolerance):
+            regressions.append(f"{kind}: p95 {old['p95']:.3f} -> {stats['p95']:.3f} s")
+    if baseline['rps'] and result['rps'] < baseline['rps'] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['rps']:.2f} -> {result['rps']:.2f} msg/s")
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16, help="сообщений в обработке одновременно")
+    parser.add_argument("--users", type=int, default=20, help="пользователей на каждый тип сообщений")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("video=5,audio=2,all=1,qr=2"))
+    parser.add_argument("--small-mb", type=int, default=5)
+    parser.add_argument("--large-mb", type=int, default=60, help="больше MAX_TELEGRAM_SIZE - уходит в облако")
+    parser.add_argument("--large-ratio", type=float, default=0.1)
+    parser.add_argument("--links", type=int, default=5, help="ссылок в сообщении типа multi")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="доля повторных ссылок")
+    parser.add_argument("--no-yandex", action="store_true", help="не подключать заглушку Яндекс.Диска")
+    parser.add_argument("--local-api", action="store_true", help="бот работает со своим сервером Bot API (local mode)")
+    parser.add_argument("--workers", type=int, default=0, help="процессов BOT_ROLE=worker; 0 - всё в одном процессе")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="сохранить результат в JSON")
+    parser.add_argument("--baseline", help="сравнить с сохранённым результатом")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if not shutil.which('ffmpeg') and {'audio', 'all'} & set(args.mix):
+        print("⚠️ ffmpeg не найден: сообщения audio/all будут завершаться ошибкой")
+
+    workdir = tempfile.mkdtemp(prefix="hartidash_bench_")
+    # Всё состояние бота (базы, кэши, папки задач) - в отдельной временной папке
+    os.environ["TMPDIR"] = os.path.join(workdir, "tmp")
+    os.makedirs(os.environ["TMPDIR"])
+    tempfile.tempdir = None
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ.setdefault("MAX_JOBS_PER_USER", "1000")
+    os.environ.setdefault("MAX_RUNNING_PER_USER", "1000")
+    os.environ.setdefault("MAX_QUEUE", "100000")
+    os.environ.setdefault("STATUS_EDIT_INTERVAL", "0.2")
+    os.environ.setdefault("CHAT_EDIT_INTERVAL", "0")
+    if args.workers:
+        os.environ["BOT_ROLE"] = "front"
+        os.environ.setdefault("JOB_POLL_INTERVAL", "0.1")
+
+    services = FakeServices(os.path.join(workdir, "media")).start()
+    if not args.no_yandex:
+        import yadisk
+        yadisk.settings.BASE_API_URL = services.base_url
+        os.environ["YANDEX_DISK_TOKEN"] = "bench"
+
+    try:
+        latencies, elapsed = asyncio.run(run(args, services))
+        result = report(args, latencies, elapsed, services.fetch_stats())
+    finally:
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline and not compare(result, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
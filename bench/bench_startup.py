@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Время холодного старта бота.
+
+Запускает бота в отдельном процессе против локальной заглушки Bot API
+(bench/fakes.py) и меряет время от запуска процесса до момента, когда
+приложение инициализировано и готово принимать апдейты. Отдельно показывает
+время импорта bot и через сколько после готовности в фоне проверился токен
+Яндекс.Диска (--yandex-delay делает API диска медленным, старт от этого
+не должен зависеть). Завершается с ошибкой, если медиана больше --target.
+
+    python bench/bench_startup.py --runs 5 --yandex-delay 2
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+TOKEN = "123456:bench"
+
+
+async def child(base_url):
+    """Запуск внутри дочернего процесса: печатает строки ready и yandex"""
+    started = time.perf_counter()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import bot
+    imported = time.perf_counter() - started
+
+    # Клиент создаётся в фоне, там же направляем его на заглушку
+    create_yandex_client = bot.create_yandex_client
+
+    def create_local_client():
+        import yadisk
+        yadisk.settings.BASE_API_URL = base_url
+        return create_yandex_client()
+
+    bot.create_yandex_client = create_local_client
+
+    from telegram.ext import Application
+    builder = Application.builder().token(TOKEN).base_url(f"{base_url}/bot")
+    app = bot.build_application(builder)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    print(f"ready {imported:.4f}", flush=True)
+
+    ready = time.perf_counter()
+    while bot.YANDEX_DISK_CLIENT is None and time.perf_counter() - ready < 30:
+        await asyncio.sleep(0.01)
+    print(f"yandex {time.perf_counter() - ready:.4f}", flush=True)
+
+    await app.stop()
+    await app.shutdown()
+    await bot.on_shutdown(app)
+
+
+def run_once(base_url, workdir):
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        YANDEX_DISK_TOKEN="bench",
+        TMPDIR=workdir,
+        METRICS_PORT="0",
+    )
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--child", base_url],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    )
+    ready_line = process.stdout.readline()
+    to_ready = time.perf_counter() - started
+    yandex_line = process.stdout.readline()
+    process.wait()
+    if not ready_line.startswith("ready") or not yandex_line.startswith("yandex"):
+        raise SystemExit("Дочерний процесс не запустился, запустите с --child вручную, чтобы увидеть ошибку")
+    return to_ready, float(ready_line.split()[1]), float(yandex_line.split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--yandex-delay", type=float, default=1.0, help="задержка ответов API диска, сек")
+    parser.add_argument("--target", type=float, default=1.0, help="допустимая медиана времени старта, сек")
+    parser.add_argument("--child", metavar="BASE_URL", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.run(child(args.child))
+        return
+
+    from fakes import FakeServices
+
+    workdir = tempfile.mkdtemp(prefix="hartidash_bench_")
+    services = FakeServices(os.path.join(workdir, "media"), yandex_delay=args.yandex_delay).start()
+    try:
+        results = [run_once(services.base_url, workdir) for _ in range(args.runs)]
+    finally:
+        services.stop()
+
+    print(f"{'run':>4} {'ready, s':>9} {'import, s':>10} {'yandex after ready, s':>22}")
+    for n, (to_ready, imported, yandex) in enumerate(results, 1):
+        print(f"{n:>4} {to_ready:>9.3f} {imported:>10.3f} {yandex:>22.3f}")
+    median = statistics.median(r[0] for r in results)
+    print(f"\nmedian time to ready: {median:.3f} s (target {args.target:.1f} s)")
+    if median > args.target:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Разбор входящего сообщения: старая проверка подстрок против classify_url.
+
+Старый путь: 11 подстрок через any() по тексту в нижнем регистре - любая
+строка с '.com' или '.ru' уходила в yt-dlp. Новый: ссылки из сообщения
+(extract_urls) и одно скомпилированное выражение на все платформы. Печатает
+микросекунды на сообщение и сколько сообщений каждый путь отправил бы
+на скачивание.
+
+    python bench/bench_url_classifier.py --rounds 20000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+OLD_MARKERS = ['.com', '.ru', 'http', 'www', 'youtu', 'tiktok', 'instagram', 'facebook', 'twitter', 'x.com']
+
+MESSAGES = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=abc",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://youtube.com/shorts/abcdEFGhijk",
+    "https://vm.tiktok.com/ZMabcdef/",
+    "https://www.tiktok.com/@some.user/video/7234567890123456789?is_from_webapp=1",
+    "https://www.instagram.com/reel/Cabcdefgh12/?igsh=xyz",
+    "https://www.facebook.com/watch/?v=1234567890",
+    "https://twitter.com/someone/status/1712345678901234567",
+    "https://x.com/someone/status/1712345678901234567",
+    "https://cdn.example.org/media/clip.mp4?token=abc",
+    "смотри https://www.youtube.com/watch?v=dQw4w9WgXcQ и https://x.com/a/status/1",
+    "https://example.com/articles/how-to-cook",
+    "https://mail.ru",
+    "tiktok.com/@some.user/video/7234567890123456789 lol",
+    "https://www.youtube.com/@channel",
+    "пришли мне это на почту ivan@example.com",
+    "привет, как дела?",
+    "/qr hello world",
+]
+
+
+def old_check(text):
+    return any(x in text.lower() for x in OLD_MARKERS)
+
+
+class Message:
+    """Сообщение без разметки Telegram: extract_urls ищет ссылки сам"""
+
+    def __init__(self, text):
+        self.text = text
+
+    def parse_entities(self, types):
+        return {}
+
+
+def new_check(text):
+    return any(bot.classify_url(url) for url in bot.extract_urls(Message(text)))
+
+
+def measure(func, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in MESSAGES:
+            func(text)
+    return (time.perf_counter() - started) / (rounds * len(MESSAGES)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'path':>20} {'us/msg':>8} {'to yt-dlp':>10}")
+    for name, func in (("substrings (было)", old_check), ("classify_url", new_check)):
+        func(MESSAGES[0])
+        per_message = measure(func, args.rounds)
+        accepted = sum(1 for text in MESSAGES if func(text))
+        print(f"{name:>20} {per_message:>8.2f} {accepted:>4}/{len(MESSAGES)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Задержка обновления статистики пользователей в обработчике.
+
+Заполняет UserData заданным числом пользователей и меряет, сколько времени
+занимает add_download внутри обработчика, пока в фоне работает сброс на диск,
+а также максимальную задержку event loop за это время.
+Для сравнения меряет старую схему - полную перезапись users.json на каждое
+изменение (только для небольших баз, иначе это минуты).
+
+    python bench/bench_user_data.py --users 1000 10000 100000 1000000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+SYNC_REWRITE_LIMIT = 100_000
+
+
+def populate(users, count):
+    users.users = {
+        str(n): {'pref': 'video', 'downloads': n % 7, 'qr': 0, 'cloud_uploads': 0}
+        for n in range(count)
+    }
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+async def measure_write_behind(count, calls):
+    path = os.path.join(tempfile.mkdtemp(), 'users.json')
+    users = bot.UserData(path)
+    populate(users, count)
+    flusher = asyncio.create_task(users.run_flusher())
+
+    samples = []
+    max_lag = 0.0
+    for n in range(calls):
+        started = time.perf_counter()
+        users.add_download(n % count)
+        samples.append(time.perf_counter() - started)
+        # Пауза как между апдейтами, чтобы фоновый сброс шёл параллельно
+        slept = time.perf_counter()
+        await asyncio.sleep(0.001)
+        max_lag = max(max_lag, time.perf_counter() - slept - 0.001)
+
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+    flush_started = time.perf_counter()
+    await users.flush()
+    final_flush = time.perf_counter() - flush_started
+
+    with open(path) as f:
+        assert len(json.load(f)) == count
+    return samples, max_lag, final_flush
+
+
+def measure_sync_rewrite(count, calls):
+    path = os.path.join(tempfile.mkdtemp(), 'users.json')
+    users = bot.UserData(path)
+    populate(users, count)
+    samples = []
+    for n in range(calls):
+        started = time.perf_counter()
+        users.add_download(n % count)
+        users.save_data()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'users':>10} {'p50, us':>10} {'p99, us':>10} {'loop lag, ms':>13} {'flush, ms':>10} {'rewrite p50, ms':>16}")
+    for count in args.users:
+        samples, max_lag, final_flush = asyncio.run(measure_write_behind(count, args.calls))
+        rewrite = "-"
+        if count <= SYNC_REWRITE_LIMIT:
+            rewrite = f"{percentile(measure_sync_rewrite(count, 20), 0.5) * 1000:.2f}"
+        print(
+            f"{count:>10} {percentile(samples, 0.5) * 1e6:>10.1f} {percentile(samples, 0.99) * 1e6:>10.1f} "
+            f"{max_lag * 1000:>13.2f} {final_flush * 1000:>10.1f} {rewrite:>16}"
+        )
+
+
+if __name__ == "__main__":
+    main()
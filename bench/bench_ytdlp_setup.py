@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Накладные расходы yt-dlp на одну задачу: новый YoutubeDL на задачу против
+готового экземпляра профиля из ytdlp_worker.checkout.
+
+Прежний путь на каждую задачу: проверка cookies.txt на диске, копия файла
+в папку задачи, новый YoutubeDL (список экстракторов, cookie jar, новые
+HTTP-соединения) и его закрытие с записью cookies. Новый путь: опции
+профиля собраны при запуске, экземпляр берётся из кэша воркера.
+
+Меряется отдельно настройка (без сети) и настройка плюс extract_info
+по прямой ссылке на локальный медиасервер (bench/fakes.py).
+
+    python bench/bench_ytdlp_setup.py --jobs 200 --cookies 300
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot  # noqa: E402
+import ytdlp_worker  # noqa: E402
+from yt_dlp import YoutubeDL  # noqa: E402
+
+
+def write_cookies(path, count):
+    with open(path, 'w') as f:
+        f.write("# Netscape HTTP Cookie File\n")
+        for n in range(count):
+            f.write(f".youtube.com\tTRUE\t/\tTRUE\t2000000000\tcookie{n}\t{'x' * 40}\n")
+
+
+def fresh_job(opts, cookies_file, workdir, url):
+    """Как было: stat и копия cookies, новый YoutubeDL, закрытие с записью cookies"""
+    job_dir = tempfile.mkdtemp(dir=workdir)
+    opts = dict(opts, outtmpl=os.path.join(job_dir, '%(title)s.%(ext)s'))
+    if os.path.exists(cookies_file):
+        job_cookies = os.path.join(job_dir, '.cookies.txt')
+        shutil.copyfile(cookies_file, job_cookies)
+        opts['cookiefile'] = job_cookies
+    with YoutubeDL(opts) as ydl:
+        if url:
+            ydl.extract_info(url, download=False)
+    shutil.rmtree(job_dir)
+
+
+def pooled_job(opts, cookies_file, workdir, url):
+    """Как стало: готовый экземпляр профиля"""
+    job_dir = tempfile.mkdtemp(dir=workdir)
+    ydl = ytdlp_worker.checkout(dict(opts, cookiefile=cookies_file, outtmpl=os.path.join(job_dir, '%(title)s.%(ext)s')))
+    if url:
+        ydl.extract_info(url, download=False)
+    shutil.rmtree(job_dir)
+
+
+def measure(func, jobs, *args):
+    samples = []
+    for _ in range(jobs):
+        started = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000, sum(samples) / len(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--cookies", type=int, default=300, help="строк в тестовом cookies.txt")
+    args = parser.parse_args()
+
+    from fakes import FakeServices
+
+    workdir = tempfile.mkdtemp(prefix="hartidash_bench_")
+    services = FakeServices(os.path.join(workdir, "media")).start()
+    try:
+        services.media.make_video('clip.mp4', 256 * 1024)
+        url = f"{services.base_url}/media/clip.mp4"
+        cookies_file = os.path.join(workdir, 'cookies.txt')
+        write_cookies(cookies_file, args.cookies)
+        bot.init_ytdlp_options()
+        opts = dict(bot.YTDLP_PROFILES[('direct', 'video')], format=bot.VIDEO_FORMAT)
+        opts.pop('cookiefile', None)
+
+        print(f"{'path':>30} {'p50, ms':>9} {'mean, ms':>9}")
+        for name, func, target in (
+            ("setup: new YoutubeDL", fresh_job, None),
+            ("setup: pooled", pooled_job, None),
+            ("setup+extract: new YoutubeDL", fresh_job, url),
+            ("setup+extract: pooled", pooled_job, url),
+        ):
+            func(opts, cookies_file, workdir, target)  # прогрев импорта и экстракторов
+            p50, mean = measure(func, args.jobs, opts, cookies_file, workdir, target)
+            print(f"{name:>30} {p50:>9.2f} {mean:>9.2f}")
+    finally:
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Локальные заглушки внешних сервисов для бенчмарков:
+
+- FakeBotAPI    - Telegram Bot API, на который можно направить Application.builder().base_url()
+- MediaServer   - раздаёт сгенерированные медиафайлы прямыми ссылками (generic-экстрактор yt-dlp)
+- FakeYandexDisk - REST API Яндекс.Диска, достаточный для yadisk.Client (mkdir/upload/publish/meta/remove)
+
+Все три работают на tornado в отдельном процессе (FakeServices), чтобы
+синхронные вызовы бота (например, check_token при импорте) не блокировали их,
+а их собственная работа не отнимала GIL у бота.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import multiprocessing
+import shutil
+import subprocess
+import time
+import urllib.request
+from collections import Counter
+
+import tornado.web
+
+
+def _message(message_id, chat_id, **extra):
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': int(chat_id), 'type': 'private'},
+    }
+    message.update(extra)
+    return message
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: отвечает на методы, которыми пользуется бот, и считает вызовы"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.bytes_received = 0
+        self.local_files = []  # пути файлов, переданных как file:// (режим локального Bot API)
+        self._ids = itertools.count(1)
+
+    def routes(self):
+        return [(r"/bot[^/]+/(\w+)", _BotMethodHandler, {'api': self})]
+
+    def param(self, handler, name, default=None):
+        values = handler.request.body_arguments.get(name)
+        if values:
+            value = values[0].decode()
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+        if handler.request.headers.get('Content-Type', '').startswith('application/json') and handler.request.body:
+            return json.loads(handler.request.body).get(name, default)
+        return default
+
+    def media(self, handler, name):
+        """Возвращает file_id для поля: загруженный файл, file:// путь или уже готовый file_id"""
+        files = handler.request.files.get(name)
+        if files:
+            self.bytes_received += len(files[0]['body'])
+            return f"fid_{next(self._ids)}"
+        value = self.param(handler, name)
+        if isinstance(value, str) and value.startswith('attach://'):
+            attached = handler.request.files.get(value[len('attach://'):])
+            self.bytes_received += len(attached[0]['body']) if attached else 0
+            return f"fid_{next(self._ids)}"
+        if isinstance(value, str) and value.startswith('file://'):
+            path = value[len('file://'):]
+            self.local_files.append(path)
+            self.bytes_received += os.path.getsize(path) if os.path.exists(path) else 0
+            return f"fid_{next(self._ids)}"
+        return value
+
+    def call(self, handler, method):
+        self.calls[method] += 1
+        chat_id = self.param(handler, 'chat_id', 0)
+        message_id = next(self._ids)
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot',
+                    'can_join_groups': True, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method in ('deleteMessage', 'answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+            return True
+        if method == 'getUpdates':
+            return []
+        if method in ('sendMessage', 'editMessageText'):
+            return _message(self.param(handler, 'message_id', message_id), chat_id, text=self.param(handler, 'text', ''))
+        if method == 'sendVideo':
+            file_id = self.media(handler, 'video')
+            return _message(message_id, chat_id, video={'file_id': file_id, 'file_unique_id': file_id,
+                                                        'width': 640, 'height': 360, 'duration': 1})
+        if method == 'sendAudio':
+            file_id = self.media(handler, 'audio')
+            return _message(message_id, chat_id, audio={'file_id': file_id, 'file_unique_id': file_id, 'duration': 1})
+        if method == 'sendPhoto':
+            file_id = self.media(handler, 'photo')
+            return _message(message_id, chat_id, photo=[{'file_id': file_id, 'file_unique_id': file_id,
+                                                         'width': 100, 'height': 100}])
+        if method == 'sendDocument':
+            file_id = self.media(handler, 'document')
+            return _message(message_id, chat_id, document={'file_id': file_id, 'file_unique_id': file_id})
+        if method == 'sendMediaGroup':
+            messages = []
+            for item in self.param(handler, 'media', []):
+                media = item['media']
+                if media.startswith('attach://'):
+                    attached = handler.request.files.get(media[len('attach://'):])
+                    self.bytes_received += len(attached[0]['body']) if attached else 0
+                elif media.startswith('file://'):
+                    self.local_files.append(media[len('file://'):])
+                file_id = f"fid_{next(self._ids)}"
+                payload = {'file_id': file_id, 'file_unique_id': file_id}
+                kind = item['type']
+                if kind == 'photo':
+                    payload = [dict(payload, width=100, height=100)]
+                elif kind == 'video':
+                    payload.update(width=640, height=360, duration=1)
+                elif kind == 'audio':
+                    payload.update(duration=1)
+                messages.append(_message(next(self._ids), chat_id, **{kind: payload}))
+            return messages
+        return True
+
+
+class _BotMethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def post(self, method):
+        self.write({'ok': True, 'result': self.api.call(self, method)})
+
+    get = post
+
+
+class MediaServer:
+    """Раздаёт медиафайлы по прямым ссылкам /media/<имя>"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def routes(self):
+        return [(r"/media/(.*)", tornado.web.StaticFileHandler, {'path': self.root})]
+
+    def make_video(self, name, size):
+        """
+        Создаёт видеофайл примерно заданного размера. С ffmpeg это настоящее
+        проигрываемое видео со звуком, без него - заглушка из случайных байт.
+        """
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            return path
+        if shutil.which('ffmpeg'):
+            # Битрейт подбираем так, чтобы 10 секунд весили примерно size байт
+            bitrate = max(64_000, size * 8 // 10)
+            subprocess.run([
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'lavfi', '-i', 'testsrc2=size=640x360:rate=25',
+                '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+                '-t', '10', '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', str(bitrate),
+                '-maxrate', str(bitrate), '-bufsize', str(bitrate),
+                '-c:a', 'aac', '-b:a', '64k', '-movflags', '+faststart', path,
+            ], check=True)
+        else:
+            with open(path, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    chunk = os.urandom(min(remaining, 1024 * 1024))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+        return path
+
+
+class FakeYandexDisk:
+    """REST API Яндекс.Диска в объёме, который использует бот"""
+
+    def __init__(self, delay=0.0):
+        self.base_url = None
+        self.delay = delay  # задержка каждого ответа, секунд: медленный API для проверки старта
+        self.calls = Counter()
+        self.bytes_received = 0
+        self.resources = {}  # путь -> 'dir' или размер файла
+        self.published = set()
+        self._ids = itertools.count(1)
+
+    def routes(self):
+        return [
+            (r"/v1/disk/?", _YandexDiskInfoHandler, {'disk': self}),
+            (r"/v1/disk/resources/upload", _YandexUploadLinkHandler, {'disk': self}),
+            (r"/v1/disk/resources/publish", _YandexPublishHandler, {'disk': self}),
+            (r"/v1/disk/resources", _YandexResourceHandler, {'disk': self}),
+            (r"/v1/disk/operations/(\w+)", _YandexOperationHandler, {'disk': self}),
+            (r"/upload/(\d+)", _YandexUploadHandler, {'disk': self}),
+        ]
+
+
+class _YandexHandler(tornado.web.RequestHandler):
+    def initialize(self, disk):
+        self.disk = disk
+
+    async def prepare(self):
+        self.disk.calls[f"{self.request.method} {self.request.path}"] += 1
+        if self.disk.delay:
+            await asyncio.sleep(self.disk.delay)
+
+    def error(self, status, name):
+        self.set_status(status)
+        self.write({'error': name, 'description': name, 'message': name})
+
+
+class _YandexDiskInfoHandler(_YandexHandler):
+    def get(self):
+        self.write({'total_space': 10 ** 12, 'used_space': 0, 'trash_size': 0})
+
+
+class _YandexOperationHandler(_YandexHandler):
+    def get(self, operation_id):
+        # check_token() спрашивает заведомо несуществующую операцию
+        self.error(404, 'DiskOperationNotFoundError')
+
+
+class _YandexResourceHandler(_YandexHandler):
+    def get(self):
+        path = self.get_argument('path')
+        if path not in self.disk.resources:
+            return self.error(404, 'DiskNotFoundError')
+        meta = {'path': f"disk:{path}", 'name': os.path.basename(path)}
+        if path in self.disk.published:
+            meta['public_url'] = f"{self.disk.base_url}/public/{abs(hash(path))}"
+        self.write(meta)
+
+    def put(self):
+        path = self.get_argument('path')
+        if path in self.disk.resources:
+            return self.error(409, 'DiskPathPointsToExistentDirectoryError')
+        self.disk.resources[path] = 'dir'
+        self.set_status(201)
+        self.write({'href': f"{self.disk.base_url}/v1/disk/resources?path={path}", 'method': 'GET'})
+
+    def delete(self):
+        path = self.get_argument('path')
+        if self.disk.resources.pop(path, None) is None:
+            return self.error(404, 'DiskNotFoundError')
+        self.set_status(204)
+
+
+class _YandexUploadLinkHandler(_YandexHandler):
+    pending = {}
+
+    def get(self):
+        upload_id = str(next(self.disk._ids))
+        self.pending[upload_id] = self.get_argument('path')
+        self.write({'href': f"{self.disk.base_url}/upload/{upload_id}", 'method': 'PUT', 'templated': False})
+
+
+@tornado.web.stream_request_body
+class _YandexUploadHandler(_YandexHandler):
+    async def prepare(self):
+        await super().prepare()
+        self.received = 0
+
+    def data_received(self, chunk):
+        self.received += len(chunk)
+
+    def put(self, upload_id):
+        path = _YandexUploadLinkHandler.pending.pop(upload_id)
+        self.disk.resources[path] = self.received
+        self.disk.bytes_received += self.received
+        self.set_status(201)
+
+
+class _YandexPublishHandler(_YandexHandler):
+    def put(self):
+        path = self.get_argument('path')
+        self.disk.published.add(path)
+        self.write({'href': f"{self.disk.base_url}/v1/disk/resources?path={path}", 'method': 'GET'})
+
+
+class _StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, services):
+        self.services = services
+
+    def get(self):
+        self.write(self.services.stats())
+
+
+class FakeServices:
+    """
+    Запускает все заглушки на одном порту в отдельном процессе, чтобы их работа
+    не делила GIL с ботом и не искажала замеры. Счётчики забираются через /_stats.
+    """
+
+    def __init__(self, media_root, port=0, yandex_delay=0.0):
+        self.bot_api = FakeBotAPI()
+        self.media = MediaServer(media_root)
+        self.yandex = FakeYandexDisk(yandex_delay)
+        self.port = port
+        self._process = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def stats(self):
+        return {
+            'bot_api_calls': dict(self.bot_api.calls),
+            'telegram_bytes': self.bot_api.bytes_received,
+            'local_files': self.bot_api.local_files,
+            'yandex_calls': dict(self.yandex.calls),
+            'yandex_bytes': self.yandex.bytes_received,
+        }
+
+    def fetch_stats(self):
+        """Счётчики из процесса заглушек"""
+        with urllib.request.urlopen(f"{self.base_url}/_stats") as response:
+            return json.load(response)
+
+    def _serve(self, conn):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = tornado.web.Application(
+            self.bot_api.routes() + self.media.routes() + self.yandex.routes()
+            + [(r"/_stats", _StatsHandler, {'services': self})],
+            log_function=lambda handler: None,
+        )
+        server = app.listen(self.port, address='127.0.0.1', max_body_size=4 * 1024 ** 3)
+        self.port = next(iter(server._sockets.values())).getsockname()[1]
+        self.yandex.base_url = self.base_url
+        conn.send(self.port)
+        loop.run_forever()
+
+    def start(self):
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.get_context('fork').Process(
+            target=self._serve, args=(child,), name="bench-fakes", daemon=True
+        )
+        self._process.start()
+        self.port = parent.recv()
+        return self
+
+    def stop(self):
+        if self._process:
+            self._process.terminate()
+            self._process.join()
@@ -2,18 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import sys
 import logging
+import io
 import tempfile
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from collections import OrderedDict, deque
 import asyncio
 from datetime import datetime, timedelta
 import shutil
+import signal
 import json
 import time
-from threading import Timer
-import requests
+import sqlite3
+import heapq
+import socket
+import uuid
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from contextlib import asynccontextmanager, ExitStack
+from pathlib import Path
+from contextvars import ContextVar
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    Message,
+    MessageEntity,
+)
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -22,20 +45,9 @@ from telegram.ext import (
     filters,
     ContextTypes
 )
-import yt_dlp
-import qrcode
-import yadisk
-# ВРЕМЕННАЯ ОТЛАДКА - удалить потом
-import os
-print("=== ОТЛАДКА ФАЙЛОВ ===")
-print("Текущая папка:", os.getcwd())
-print("Файлы в папке:", os.listdir('.'))
-if os.path.exists('cookies.txt'):
-    print("✅ cookies.txt НАЙДЕН!")
-    print("Размер:", os.path.getsize('cookies.txt'), "байт")
-else:
-    print("❌ cookies.txt НЕ НАЙДЕН!")
-print("=====================")
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, start_http_server, CONTENT_TYPE_LATEST
+# yt_dlp, qrcode, yadisk, requests и tornado импортируются там, где нужны:
+# так бот начинает принимать апдейты быстрее (см. warm_up_imports)
 # ===================== НАСТРОЙКА ЛОГИРОВАНИЯ =====================
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -52,150 +64,492 @@ if not BOT_TOKEN:
 
 # Yandex.Disk настройки
 YANDEX_DISK_TOKEN = os.environ.get("YANDEX_DISK_TOKEN")
-YANDEX_DISK_CLIENT = None
-
-if YANDEX_DISK_TOKEN:
-    try:
-        YANDEX_DISK_CLIENT = yadisk.Client(token=YANDEX_DISK_TOKEN)
-        # Проверяем, работает ли токен
-        if YANDEX_DISK_CLIENT.check_token():
-            logger.info("✅ Yandex.Disk клиент успешно создан и токен валиден")
-        else:
-            logger.error("❌ Токен Yandex.Disk невалиден")
-            YANDEX_DISK_CLIENT = None
-    except Exception as e:
-        logger.error(f"❌ Ошибка создания Yandex.Disk клиента: {e}")
-        YANDEX_DISK_CLIENT = None
-else:
-    logger.info("⚠️ Yandex.Disk не настроен (переменная YANDEX_DISK_TOKEN отсутствует)")
+YANDEX_DISK_CLIENT = None  # создаётся и проверяется в фоне после запуска, см. connect_yandex
 
 # Временная директория
 TEMP_DIR = tempfile.gettempdir()
-MAX_TELEGRAM_SIZE = 50 * 1024 * 1024  # 50 МБ - лимит Telegram
-MAX_YANDEX_SIZE = 100 * 1024 * 1024  # 100 МБ - ограничение API Яндекс.Диска для одного файла (можно увеличить)
+MAX_TELEGRAM_SIZE = int(os.environ.get("MAX_TELEGRAM_SIZE", 50 * 1024 * 1024))  # лимит облачного Bot API на отправку файла
+MAX_YANDEX_SIZE = int(os.environ.get("MAX_YANDEX_SIZE", 100 * 1024 * 1024))  # байт на один файл в облаке, больше не загружаем
+YANDEX_FOLDER = "/HartiDash"
+YANDEX_UPLOAD_WORKERS = int(os.environ.get("YANDEX_UPLOAD_WORKERS", 3))  # одновременных загрузок на диск
+YANDEX_CHUNK_SIZE = int(os.environ.get("YANDEX_CHUNK_SIZE", 1024 * 1024))  # размер буфера при отправке файла
+LOOP_LAG_WARNING = float(os.environ.get("LOOP_LAG_WARNING", 0.1))  # секунд задержки event loop до предупреждения
+
+# Свой сервер Bot API (telegram-bot-api --local): файлы до 2 ГБ отправляются
+# прямо из TEMP_DIR по пути, без multipart и без Яндекс.Диска. Сервер должен
+# видеть TEMP_DIR по тому же пути (общий том или одна машина)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # например http://localhost:8081/bot
+TELEGRAM_FILE_URL = os.environ.get("TELEGRAM_FILE_URL")  # например http://localhost:8081/file/bot
+TELEGRAM_LOCAL_MODE = os.environ.get("TELEGRAM_LOCAL_MODE", "1" if TELEGRAM_API_URL else "0") == "1"
+MAX_LOCAL_API_SIZE = int(os.environ.get("MAX_LOCAL_API_SIZE", 2000 * 1024 * 1024))  # лимит своего сервера Bot API
+LOCAL_API_READ_TIMEOUT = float(os.environ.get("LOCAL_API_READ_TIMEOUT", 600))  # секунд ждать ответа своего сервера: он сам заливает файл в Telegram
+
+# Файлы больше лимита Bot API: нарезка на части без перекодирования или облако
+SPLIT_MAX_PARTS = int(os.environ.get("SPLIT_MAX_PARTS", 10))  # частей максимум (один альбом), больше - только облако
+SPLIT_LATENCY_SLACK = float(os.environ.get("SPLIT_LATENCY_SLACK", 2.0))  # во сколько раз нарезка может быть дольше облака: файл в чате удобнее ссылки
+SPLIT_PART_FILL = 0.9  # целевой размер части от лимита: ffmpeg режет по ключевым кадрам, части выходят неровными
+SPLIT_ATTEMPTS = 3  # попыток подобрать длину части, если какая-то вышла больше лимита
+TELEGRAM_RATE_ESTIMATE = 8 * 1024 * 1024  # байт/с отправки в Telegram, пока нет замеров
+YANDEX_RATE_ESTIMATE = 4 * 1024 * 1024  # байт/с загрузки на Яндекс.Диск, пока нет замеров
+SPLIT_RATE_ESTIMATE = 200 * 1024 * 1024  # байт/с нарезки ffmpeg -c copy, пока нет замеров
+
+# Проверка ссылки перед скачиванием: метаданные без скачивания, кэш по ссылке
+PREFLIGHT = os.environ.get("PREFLIGHT", "1") == "1"  # 0 - качать сразу, размер проверяется после скачивания
+INFO_CACHE_TTL = int(os.environ.get("INFO_CACHE_TTL", 600))  # секунд; прямые ссылки на форматы быстро истекают
+INFO_CACHE_SIZE = int(os.environ.get("INFO_CACHE_SIZE", 200))  # info-словарей в памяти (без субтитров ~50-150 КБ каждый)
+
+# Подбор формата под лимит Telegram, когда формат по умолчанию в него не влезает
+SIZE_BUDGET = int(os.environ.get("SIZE_BUDGET", 0))  # байт на файл; 0 - лимит текущего Bot API
+SIZE_BUDGET_MARGIN = 0.95  # оценки по битрейту неточны, оставляем запас
+FORMAT_MIN_HEIGHT = int(os.environ.get("FORMAT_MIN_HEIGHT", 360))  # ниже этого качества не опускаемся
+REENCODE_FALLBACK = os.environ.get("REENCODE_FALLBACK", "0") == "1"  # перекодировать в нужный битрейт, если ни один формат не влез
+REENCODE_MIN_VIDEO_KBPS = int(os.environ.get("REENCODE_MIN_VIDEO_KBPS", 400))  # ниже этого битрейта видео не перекодируем
+REENCODE_AUDIO_KBPS = 96  # битрейт звука в перекодированном видео
+
+# Параллельная обработка
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))  # одновременных скачиваний на весь бот
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", 3))  # задач одного пользователя в очереди и в работе
+MAX_RUNNING_PER_USER = int(os.environ.get("MAX_RUNNING_PER_USER", 1))  # из них скачивается одновременно
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", 200))  # задач в очереди на весь бот, дальше отказываем (ссылки не упираются в CONCURRENT_UPDATES)
+MAX_BYTES_IN_FLIGHT = int(os.environ.get("MAX_BYTES_IN_FLIGHT", 2 * 1024 * 1024 * 1024))  # оценка байт в скачивании
+DOWNLOAD_PROCESSES = int(os.environ.get("DOWNLOAD_PROCESSES", DOWNLOAD_WORKERS))  # процессов yt-dlp
+DOWNLOAD_TIMEOUT = int(os.environ.get("DOWNLOAD_TIMEOUT", 1800))  # секунд на одно скачивание, дальше процесс убивается
+STATUS_EDIT_INTERVAL = float(os.environ.get("STATUS_EDIT_INTERVAL", 3))  # секунд между правками статуса
+CHAT_EDIT_INTERVAL = float(os.environ.get("CHAT_EDIT_INTERVAL", 1))  # секунд между правками в одном чате
+STATUS_MAX_EDITS = int(os.environ.get("STATUS_MAX_EDITS", 30))  # правок статуса на одну задачу
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))  # апдейтов Telegram в обработке одновременно
+MAX_LINKS_PER_MESSAGE = int(os.environ.get("MAX_LINKS_PER_MESSAGE", 10))  # ссылок из одного сообщения
+PLAYLIST_LIMIT = int(os.environ.get("PLAYLIST_LIMIT", 10))  # роликов из одного плейлиста
+MEDIA_GROUP_SIZE = 10  # лимит Bot API на один sendMediaGroup
 
-# Файл для хранения информации о загруженных файлах
-FILES_DB = os.path.join(TEMP_DIR, 'yandex_files.json')
+# Роли процессов: all - всё в одном процессе; front - принимает апдейты, отвечает
+# на меню и кладёт скачивания в очередь; worker - берёт их из очереди, качает и
+# отправляет. Front и воркеры делят DATA_DIR и должны быть на одном хосте: базы в режиме
+# WAL держат индекс в разделяемой памяти, на сетевом томе они портятся
+BOT_ROLE = os.environ.get("BOT_ROLE", "all")  # all, front или worker
+if BOT_ROLE not in ('all', 'front', 'worker'):
+    raise ValueError(f"❌ Неизвестная роль BOT_ROLE={BOT_ROLE}, нужна all, front или worker")
+DATA_DIR = os.environ.get("DATA_DIR", TEMP_DIR)  # базы и кэши, общие для front и воркеров
+JOB_QUEUE_DB = os.path.join(DATA_DIR, 'jobs.sqlite3')
+JOB_WORKER_SLOTS = int(os.environ.get("JOB_WORKER_SLOTS", DOWNLOAD_WORKERS))  # заданий из очереди одновременно на воркер
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))  # секунд между опросами очереди
+JOB_LEASE = 60  # секунд: задание воркера, который столько не отзывался, возвращается в очередь
+JOB_MAX_ATTEMPTS = 2  # сколько раз выдавать задание, если воркеры пропадают посреди него
+FILES_RESCAN_INTERVAL = 60  # секунд: front подхватывает сроки удаления файлов, загруженных воркерами
+
+# Временные папки задач
+TEMP_QUOTA = int(os.environ.get("TEMP_QUOTA", 5 * 1024 * 1024 * 1024))  # байт под папки задач, дальше задачи ждут
+TEMP_MIN_FREE = int(os.environ.get("TEMP_MIN_FREE", 512 * 1024 * 1024))  # байт, которые всегда оставляем свободными на диске
+TEMP_ORPHAN_AGE = int(os.environ.get("TEMP_ORPHAN_AGE", 3600))  # секунд, после которых чужая папка harti_* считается брошенной
+TEMP_RECLAIM_INTERVAL = int(os.environ.get("TEMP_RECLAIM_INTERVAL", 600))  # секунд между уборками брошенных папок
+TEMP_DIR_PRIVATE = os.environ.get("TEMP_DIR_PRIVATE", "0") == "1"  # TMPDIR только у этого процесса: при запуске чистим все папки
+
+# База с информацией о загруженных файлах (SQLite в режиме WAL)
+FILES_DB = os.path.join(DATA_DIR, 'yandex_files.sqlite3')
+FILES_DB_LEGACY = os.path.join(DATA_DIR, 'yandex_files.json')  # старый формат, переносится при первом запуске
+FILES_RETENTION = int(os.environ.get("FILES_RETENTION", 7 * 24 * 3600))  # сколько секунд хранить записи об удалённых файлах
+FILES_TTL = 12 * 3600  # через сколько секунд файл удаляется из облака
+YANDEX_DELETE_CONCURRENCY = int(os.environ.get("YANDEX_DELETE_CONCURRENCY", 4))  # параллельных удалений с диска
+DELETE_RETRY_DELAY = 300  # секунд до повторной попытки удаления после ошибки
+COMPACT_INTERVAL = 3600  # секунд между уплотнениями базы файлов
+
+# QR-коды
+QR_WORKERS = int(os.environ.get("QR_WORKERS", 2))  # потоков для рендеринга QR
+QR_CACHE_SIZE = int(os.environ.get("QR_CACHE_SIZE", 1000))  # готовых QR в памяти
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+
+# Статистика пользователей пишется на диск пачками
+USERS_FLUSH_INTERVAL = float(os.environ.get("USERS_FLUSH_INTERVAL", 5))  # секунд между сбросами на диск
+USERS_FLUSH_BATCH = int(os.environ.get("USERS_FLUSH_BATCH", 1000))  # изменений, после которых сбрасываем раньше
+
+# Кэш готовых результатов (file_id Telegram)
+RESULT_CACHE_DB = os.path.join(DATA_DIR, 'result_cache.json')
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 7 * 24 * 3600))  # секунд
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 5000))  # записей
+RESULT_CACHE_FLUSH_INTERVAL = float(os.environ.get("RESULT_CACHE_FLUSH_INTERVAL", 5))  # секунд между сбросами на диск
+
+# Форматы yt-dlp для каждого режима (входят в ключ кэша)
+VIDEO_FORMAT = 'best[ext=mp4]/best'
+# Платформы, которым нужен свой формат видео, остальные качают VIDEO_FORMAT
+PLATFORM_VIDEO_FORMATS = {
+    # H.265 (bytevc1) Telegram проигрывает не во всех клиентах, поэтому H.264
+    'tiktok': 'best[ext=mp4][vcodec^=h264]/best[ext=mp4]/best',
+    # Прямой mp4 вместо сборки из сегментов HLS
+    'x': 'best[ext=mp4][protocol^=http]/best[ext=mp4]/best',
+}
+# copy - берём родную AAC-дорожку и только перепаковываем её в m4a, перекодируем
+# лишь несовместимые кодеки; mp3 - как раньше, всегда перекодируем в MP3
+AUDIO_POLICY = os.environ.get("AUDIO_POLICY", "copy")
+if AUDIO_POLICY == 'mp3':
+    AUDIO_FORMAT = 'bestaudio/best'
+    AUDIO_CODEC = 'mp3'
+else:
+    # Bot API проигрывает в sendAudio только MP3 и M4A, поэтому AAC в приоритете
+    AUDIO_FORMAT = 'bestaudio[acodec^=mp4a]/bestaudio[ext=m4a]/bestaudio/best'
+    AUDIO_CODEC = 'm4a'
+AUDIO_QUALITY = '192'  # кбит/с, если всё же приходится перекодировать
 
 logger.info(f"📁 Временная директория: {TEMP_DIR}")
-logger.info(f"📦 Максимальный размер для Telegram: {MAX_TELEGRAM_SIZE / 1024 / 1024} МБ")
+if TELEGRAM_API_URL:
+    logger.info(f"🛰️ Свой сервер Bot API: {TELEGRAM_API_URL} (local mode: {'да' if TELEGRAM_LOCAL_MODE else 'нет'})")
+logger.info(f"📦 Максимальный размер для Telegram: "
+            f"{(MAX_LOCAL_API_SIZE if TELEGRAM_LOCAL_MODE else MAX_TELEGRAM_SIZE) / 1024 / 1024:.0f} МБ")
+logger.info(f"⚙️ Воркеров скачивания: {DOWNLOAD_WORKERS}, задач на пользователя: {MAX_JOBS_PER_USER}")
+if BOT_ROLE != 'all':
+    logger.info(f"🧩 Роль процесса: {BOT_ROLE}, очередь заданий: {JOB_QUEUE_DB}")
+
+# ===================== МЕТРИКИ =====================
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9090))  # порт /metrics в режиме polling, 0 - выключить
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # необязательный secret_token вебхука
+
+# Ссылки на ролики по платформам (без схемы); direct - прямая ссылка на медиафайл.
+# Всё, что не подошло ни под один шаблон, отклоняется до запуска yt-dlp
+PLATFORM_PATTERNS = {
+    'youtube': r'(?:(?:www|m|music)\.)?youtube\.com/(?:watch\?|shorts/|live/|embed/|playlist\?)|youtu\.be/[\w-]',
+    'tiktok': r'(?:vm|vt)\.tiktok\.com/\w|(?:(?:www|m)\.)?tiktok\.com/(?:@[\w.-]+/video/\d|t/\w|v/\d)',
+    'instagram': r'(?:www\.)?instagram\.com/(?:(?:[\w.]+/)?(?:p|reels?|tv)/[\w-]|stories/[\w.]+/\d)',
+    'facebook': r'(?:(?:www|m|web)\.)?facebook\.com/(?:watch|reel/|share/[rv]/|[\w.-]+/videos/|video\.php)|fb\.watch/\w',
+    'x': r'(?:(?:www|mobile)\.)?(?:twitter|x)\.com/\w+/status/\d',
+    'direct': r'[\w.-]+(?::\d+)?/[^?#\s]*\.(?:mp4|m4a|mp3|webm|mov|mkv)(?:[?#]|$)',
+}
+# Одно выражение на все платформы: платформа - имя сработавшей группы
+URL_CLASSIFIER = re.compile(
+    r'(?:https?://)?(?:' + '|'.join(f"(?P<{name}>{pattern})" for name, pattern in PLATFORM_PATTERNS.items()) + ')',
+    re.IGNORECASE
+)
+
+def classify_url(url):
+    """Платформа ссылки на ролик ('youtube', 'tiktok', ..., 'direct') или None, если это не медиа"""
+    match = URL_CLASSIFIER.match(url.strip())
+    return match.lastgroup if match else None
+
+def detect_platform(url):
+    """Платформа ссылки для меток метрик"""
+    return classify_url(url) or 'other'
+
+STAGE_SECONDS = Histogram(
+    'hartidash_stage_seconds', 'Длительность этапов обработки ссылки',
+    ['stage', 'platform', 'mode'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320, 640)
+)
+DOWNLOADED_BYTES = Counter('hartidash_downloaded_bytes_total', 'Скачано байт', ['platform', 'mode'])
+UPLOADED_BYTES = Counter('hartidash_uploaded_bytes_total', 'Отправлено байт', ['destination'])
+CACHE_LOOKUPS = Counter('hartidash_cache_lookups_total', 'Обращения к кэшам', ['cache', 'result'])
+FAILURES = Counter('hartidash_failures_total', 'Ошибки по причинам', ['reason'])
+FORMAT_PLANS = Counter('hartidash_format_plans_total', 'Подбор формата под лимит Telegram', ['result'])
+QUEUE_DEPTH = Gauge('hartidash_queue_depth', 'Задач в очереди на скачивание')
+WORKERS_IN_FLIGHT = Gauge('hartidash_workers_in_flight', 'Занятых воркеров скачивания')
+TEMP_DIR_BYTES = Gauge('hartidash_temp_dir_bytes', 'Занято временными папками задач')
+DELIVERY_PATHS = Counter('hartidash_delivery_total', 'Файлы по способу доставки', ['path'])
+
+# Значения считаются в момент запроса /metrics
+QUEUE_DEPTH.set_function(lambda: download_pool.waiting)
+WORKERS_IN_FLIGHT.set_function(lambda: download_pool.in_flight)
+TEMP_DIR_BYTES.set_function(lambda: temp_space.usage())
+
+class DownloadMetrics:
+    """Делит время скачивания на этапы по хукам yt-dlp"""
+    
+    def __init__(self, platform, mode):
+        self.platform = platform
+        self.mode = mode
+        self.started = time.monotonic()
+        self._download_started = None
+        self._pp_started = {}
+    
+    def observe(self, stage, seconds):
+        STAGE_SECONDS.labels(stage, self.platform, self.mode).observe(seconds)
+    
+    def download_hook(self, d):
+        now = time.monotonic()
+        if d['status'] == 'downloading' and self._download_started is None:
+            self._download_started = now
+            self.observe('extract', now - self.started)
+        elif d['status'] == 'finished':
+            if self._download_started is not None:
+                self.observe('download', now - self._download_started)
+                self._download_started = None
+            DOWNLOADED_BYTES.labels(self.platform, self.mode).inc(
+                d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            )
+            # Следующий файл той же задачи снова начнёт отсчёт
+            self.started = now
+    
+    def postprocessor_hook(self, d):
+        name = d.get('postprocessor')
+        if d['status'] == 'started':
+            self._pp_started[name] = time.monotonic()
+        elif d['status'] == 'finished' and name in self._pp_started:
+            self.observe('postprocess', time.monotonic() - self._pp_started.pop(name))
 
 # ===================== ХРАНЕНИЕ ДАННЫХ О ФАЙЛАХ =====================
 class FileManager:
-    """Класс для управления файлами с автоудалением через 12 часов"""
+    """
+    Класс для управления файлами с автоудалением через 12 часов.
+    Сроки удаления держатся в min-куче, асинхронный планировщик спит до
+    ближайшего из них. Куча и планировщик живут только в event loop.
+    База общая для всех процессов одного хоста (SQLite сам разбирается с блокировками):
+    воркеры только добавляют файлы, удаляет их планировщик front.
+    """
     
-    def __init__(self):
-        self.files = {}
-        self.load_files()
-        self.start_cleanup_scheduler()
+    COLUMNS = ('file_id', 'local_path', 'yandex_path', 'public_url', 'user_id', 'chat_id',
+               'upload_time', 'delete_time', 'deleted')
     
-    def load_files(self):
-        """Загружает информацию о файлах из JSON"""
-        try:
-            if os.path.exists(FILES_DB):
-                with open(FILES_DB, 'r') as f:
-                    self.files = json.load(f)
-                logger.info(f"📂 Загружено {len(self.files)} файлов из базы")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки базы файлов: {e}")
-            self.files = {}
+    def __init__(self, db_path=FILES_DB, legacy_path=FILES_DB_LEGACY):
+        # Соединение общее для event loop и потока очистки, поэтому под замком
+        self._lock = Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                file_id     TEXT PRIMARY KEY,
+                local_path  TEXT,
+                yandex_path TEXT NOT NULL,
+                public_url  TEXT,
+                user_id     TEXT,
+                chat_id     TEXT,
+                upload_time REAL NOT NULL,
+                delete_time REAL NOT NULL,
+                deleted     INTEGER NOT NULL DEFAULT 0,
+                deleted_at  REAL
+            )
+        """)
+        # Частичные индексы: выборка истёкших и уплотнение не сканируют всю таблицу
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_pending ON files(delete_time) WHERE deleted = 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_deleted ON files(deleted_at) WHERE deleted = 1")
+        self.migrate_json(legacy_path)
+        self._deadlines = []  # min-куча (время удаления, file_id)
+        self._wakeup = asyncio.Event()
     
-    def save_files(self):
-        """Сохраняет информацию о файлах в JSON"""
+    def migrate_json(self, legacy_path):
+        """Переносит записи из старого yandex_files.json в SQLite"""
+        if not os.path.exists(legacy_path):
+            return
         try:
-            with open(FILES_DB, 'w') as f:
-                json.dump(self.files, f, indent=2)
+            with open(legacy_path, 'r') as f:
+                legacy = json.load(f)
+            rows = [
+                (
+                    info['file_id'], info.get('local_path'), info['yandex_path'], info.get('public_url'),
+                    info.get('user_id'), info.get('chat_id'),
+                    datetime.fromisoformat(info['upload_time']).timestamp(),
+                    datetime.fromisoformat(info['delete_time']).timestamp(),
+                    1 if info.get('deleted') else 0,
+                    time.time() if info.get('deleted') else None,
+                )
+                for info in legacy.values()
+            ]
+            with self._lock:
+                self.db.execute("BEGIN")
+                self.db.executemany("INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.execute("COMMIT")
+            os.replace(legacy_path, legacy_path + '.migrated')
+            logger.info(f"📂 Перенесено {len(rows)} файлов из {legacy_path} в SQLite")
         except Exception as e:
-            logger.error(f"Ошибка сохранения базы файлов: {e}")
+            logger.error(f"Ошибка переноса базы файлов: {e}")
+    
+    def _row_to_info(self, row):
+        info = dict(zip(self.COLUMNS, row))
+        info['upload_time'] = datetime.fromtimestamp(info['upload_time']).isoformat()
+        info['delete_time'] = datetime.fromtimestamp(info['delete_time']).isoformat()
+        info['deleted'] = bool(info['deleted'])
+        return info
     
     def add_file(self, file_path, yandex_path, public_url, user_id, chat_id):
         """Добавляет файл в базу с временем загрузки"""
-        file_id = os.path.basename(file_path)
-        upload_time = datetime.now().isoformat()
-        delete_time = (datetime.now() + timedelta(hours=12)).isoformat()
-        
-        self.files[file_id] = {
-            'file_id': file_id,
-            'local_path': file_path,
-            'yandex_path': yandex_path,
-            'public_url': public_url,
-            'user_id': str(user_id),
-            'chat_id': str(chat_id),
-            'upload_time': upload_time,
-            'delete_time': delete_time,
-            'deleted': False
-        }
-        self.save_files()
-        logger.info(f"✅ Файл {file_id} будет удален через 12 часов")
-        return delete_time
+        # Имена скачанных файлов повторяются (одно видео у разных пользователей),
+        # поэтому у каждой загрузки свой id
+        file_id = uuid.uuid4().hex
+        upload_time = datetime.now()
+        delete_time = upload_time + timedelta(seconds=FILES_TTL)
+        
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, NULL)",
+                (file_id, file_path, yandex_path, public_url, str(user_id), str(chat_id),
+                 upload_time.timestamp(), delete_time.timestamp())
+            )
+        heapq.heappush(self._deadlines, (delete_time.timestamp(), file_id))
+        self._wakeup.set()
+        logger.info(f"✅ Файл {yandex_path} будет удален через 12 часов")
+        return delete_time.isoformat()
     
     def get_files_to_delete(self):
         """Возвращает список файлов, которые нужно удалить"""
-        now = datetime.now()
-        to_delete = []
-        
-        for file_id, file_info in self.files.items():
-            if file_info.get('deleted', False):
-                continue
-            
-            delete_time = datetime.fromisoformat(file_info['delete_time'])
-            if now >= delete_time:
-                to_delete.append((file_id, file_info))
-        
-        return to_delete
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM files WHERE deleted = 0 AND delete_time <= ? ORDER BY delete_time",
+                (time.time(),)
+            ).fetchall()
+        return [(row[0], self._row_to_info(row)) for row in rows]
     
     def mark_as_deleted(self, file_id):
         """Отмечает файл как удаленный"""
-        if file_id in self.files:
-            self.files[file_id]['deleted'] = True
-            self.save_files()
+        with self._lock:
+            self.db.execute("UPDATE files SET deleted = 1, deleted_at = ? WHERE file_id = ?", (time.time(), file_id))
+    
+    def compact(self):
+        """Удаляет из базы давно удалённые файлы"""
+        with self._lock:
+            removed = self.db.execute(
+                "DELETE FROM files WHERE deleted = 1 AND deleted_at < ?",
+                (time.time() - FILES_RETENTION,)
+            ).rowcount
+        if removed:
+            logger.info(f"🧹 Из базы файлов убрано {removed} старых записей")
+        return removed
+    
+    def get_file(self, file_id):
+        """Возвращает запись о файле или None"""
+        with self._lock:
+            row = self.db.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM files WHERE file_id = ?", (file_id,)
+            ).fetchone()
+        return self._row_to_info(row) if row else None
     
-    def start_cleanup_scheduler(self):
-        """Запускает планировщик очистки"""
-        self.check_and_delete_files()
-        Timer(1800, self.start_cleanup_scheduler).start()
+    def load_deadlines(self):
+        """Заполняет кучу сроками всех ещё не удалённых файлов"""
+        with self._lock:
+            self._deadlines = self.db.execute(
+                "SELECT delete_time, file_id FROM files WHERE deleted = 0"
+            ).fetchall()
+        heapq.heapify(self._deadlines)
+    
+    def refresh_deadlines(self):
+        """Добавляет в кучу сроки файлов, которые загрузили другие процессы (воркеры)"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT delete_time, file_id FROM files WHERE deleted = 0 AND delete_time > ?", (time.time(),)
+            ).fetchall()
+        self._deadlines = list(set(self._deadlines) | set(rows))
+        heapq.heapify(self._deadlines)
+    
+    async def run_scheduler(self):
+        """Удаляет каждый файл в момент истечения его срока"""
+        self.load_deadlines()
+        logger.info(f"⏰ Планировщик удаления запущен, файлов в ожидании: {len(self._deadlines)}")
+        last_compact = 0.0
+        last_rescan = time.time()
+        errors = 0
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            due = []
+            try:
+                if now - last_compact >= COMPACT_INTERVAL:
+                    await asyncio.to_thread(self.compact)
+                    last_compact = now
+                if BOT_ROLE == 'front' and now - last_rescan >= FILES_RESCAN_INTERVAL:
+                    await asyncio.to_thread(self.refresh_deadlines)
+                    last_rescan = now
+                
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    due.append(heapq.heappop(self._deadlines)[1])
+                if due:
+                    await self.delete_files(due)
+                    errors = 0
+                    continue
+            except Exception as e:
+                # Ошибка базы или диска не должна останавливать удаление: повторяем с паузой
+                errors += 1
+                logger.error(f"❌ Ошибка планировщика удаления: {e}")
+                for file_id in due:
+                    heapq.heappush(self._deadlines, (now + DELETE_RETRY_DELAY, file_id))
+                await asyncio.sleep(min(5 * 2 ** errors, DELETE_RETRY_DELAY))
+                continue
+            
+            errors = 0
+            timeout = FILES_RESCAN_INTERVAL if BOT_ROLE == 'front' else COMPACT_INTERVAL
+            if self._deadlines:
+                timeout = min(timeout, self._deadlines[0][0] - now)
+            try:
+                # add_file будит планировщик, если новый срок раньше текущего
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
     
-    def check_and_delete_files(self):
-        """Проверяет и удаляет файлы, время которых истекло"""
+    async def delete_files(self, file_ids):
+        """Удаляет истёкшие файлы параллельно, не больше YANDEX_DELETE_CONCURRENCY сразу"""
         if not YANDEX_DISK_CLIENT:
             return
+        logger.info(f"🔄 Начинаю очистку {len(file_ids)} файлов...")
+        semaphore = asyncio.Semaphore(YANDEX_DELETE_CONCURRENCY)
+        results = await asyncio.gather(
+            *(self._delete_one(file_id, semaphore) for file_id in set(file_ids)),
+            return_exceptions=True
+        )
+        for error in results:
+            if isinstance(error, Exception):
+                logger.error(f"❌ Ошибка очистки: {error}")
+        logger.info("✅ Очистка завершена")
+    
+    async def _delete_one(self, file_id, semaphore):
+        from yadisk.exceptions import PathNotFoundError
         
-        to_delete = self.get_files_to_delete()
-        if not to_delete:
+        file_info = self.get_file(file_id)
+        # Файл могли уже удалить (повтор из-за refresh_deadlines) или убрать при уплотнении
+        if not file_info or file_info['deleted'] or datetime.fromisoformat(file_info['delete_time']) > datetime.now():
             return
         
-        logger.info(f"🔄 Начинаю очистку {len(to_delete)} файлов...")
-        
-        for file_id, file_info in to_delete:
+        async with semaphore:
             try:
-                with YANDEX_DISK_CLIENT:
-                    # Удаляем файл с Яндекс.Диска
-                    if YANDEX_DISK_CLIENT.exists(file_info['yandex_path']):
-                        YANDEX_DISK_CLIENT.remove(file_info['yandex_path'], permanently=True)
-                        logger.info(f"✅ Удален файл с Яндекс.Диска: {file_info['yandex_path']}")
-                    
-                    # Удаляем локальный файл, если он ещё существует
-                    if os.path.exists(file_info['local_path']):
-                        os.remove(file_info['local_path'])
-                    
-                    self.mark_as_deleted(file_id)
-                
+                # Удаляем сразу, без отдельного exists: отсутствие файла - тоже успех
+                await yandex_uploader.run(YANDEX_DISK_CLIENT.remove, file_info['yandex_path'], permanently=True)
+                logger.info(f"✅ Удален файл с Яндекс.Диска: {file_info['yandex_path']}")
+            except PathNotFoundError:
+                pass
             except Exception as e:
                 logger.error(f"❌ Ошибка удаления файла {file_id}: {e}")
+                heapq.heappush(self._deadlines, (time.time() + DELETE_RETRY_DELAY, file_id))
+                return
         
-        logger.info("✅ Очистка завершена")
+        # Удаляем локальный файл, если он ещё существует
+        if file_info['local_path']:
+            try:
+                os.remove(file_info['local_path'])
+            except OSError:
+                pass
+        
+        self.mark_as_deleted(file_id)
 
-# Создаем глобальный экземпляр
-file_manager = FileManager()
+# Глобальный экземпляр открывается в on_startup (open_storage): импорт не трогает диск
+file_manager = None
 
 # ===================== ХРАНЕНИЕ ДАННЫХ ПОЛЬЗОВАТЕЛЕЙ =====================
+def write_json_atomic(path, data):
+    """Атомарно записывает JSON: во временный файл и rename поверх старого"""
+    # json.dump кодирует по кускам и отпускает GIL между ними, поэтому
+    # большая база не подвешивает event loop на всё время записи
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
 class UserData:
-    def __init__(self):
+    """
+    Статистика и настройки пользователей.
+    Изменения копятся в памяти и сбрасываются на диск в фоне:
+    раз в USERS_FLUSH_INTERVAL секунд или после USERS_FLUSH_BATCH изменений.
+    Записи не меняются на месте, а заменяются копией - снимок для фоновой
+    записи остаётся согласованным без блокировок.
+    Файл пишет один процесс: при BOT_ROLE=front/worker воркеры не трогают
+    статистику, а присылают отчёты через очередь (см. record_delivery).
+    """
+    
+    def __init__(self, data_file=None):
         self.users = {}
-        self.data_file = os.path.join(TEMP_DIR, 'users.json')
-        self.load_data()
+        self.data_file = data_file or os.path.join(DATA_DIR, 'users.json')
+        self._dirty = 0
+        self._flush_requested = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
     
     def load_data(self):
+        """Читает базу с диска; вызывается из on_startup в фоновом потоке"""
         try:
             if os.path.exists(self.data_file):
                 with open(self.data_file, 'r') as f:
@@ -203,12 +557,54 @@ class UserData:
         except:
             self.users = {}
     
+    def _write(self, snapshot):
+        write_json_atomic(self.data_file, snapshot)
+    
     def save_data(self):
+        """Синхронно сбрасывает все изменения на диск"""
         try:
-            with open(self.data_file, 'w') as f:
-                json.dump(self.users, f)
-        except:
-            pass
+            self._dirty = 0
+            self._write(dict(self.users))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения пользователей: {e}")
+    
+    async def flush(self):
+        """Сбрасывает накопленные изменения на диск в фоновом потоке"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            changes, self._dirty = self._dirty, 0
+            snapshot = dict(self.users)
+            write = asyncio.ensure_future(asyncio.to_thread(self._write, snapshot))
+            try:
+                # Отмена не должна бросать запись на полпути: дожидаемся её под замком
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await write
+                raise
+            except Exception as e:
+                self._dirty += changes
+                logger.error(f"Ошибка сохранения пользователей: {e}")
+    
+    async def run_flusher(self):
+        """Фоновая задача: сбрасывает изменения по таймеру или по порогу"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), USERS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+    
+    def _update(self, user_id, **changes):
+        """Заменяет запись пользователя изменённой копией и отмечает её к записи"""
+        record = dict(self.users.get(user_id) or {'pref': 'video', 'downloads': 0, 'qr': 0, 'cloud_uploads': 0})
+        for key, value in changes.items():
+            record[key] = value(record.get(key, 0)) if callable(value) else value
+        self.users[user_id] = record
+        self._dirty += 1
+        if self._dirty >= USERS_FLUSH_BATCH:
+            self._flush_requested.set()
     
     def get_preference(self, user_id):
         user_id = str(user_id)
@@ -217,30 +613,16 @@ class UserData:
         return self.users[user_id].get('pref', 'video')
     
     def set_preference(self, user_id, pref):
-        user_id = str(user_id)
-        if user_id not in self.users:
-            self.users[user_id] = {'pref': pref, 'downloads': 0, 'qr': 0, 'cloud_uploads': 0}
-        else:
-            self.users[user_id]['pref'] = pref
-        self.save_data()
+        self._update(str(user_id), pref=pref)
     
     def add_download(self, user_id, via_cloud=False):
-        user_id = str(user_id)
-        if user_id not in self.users:
-            self.users[user_id] = {'pref': 'video', 'downloads': 1, 'qr': 0, 'cloud_uploads': 1 if via_cloud else 0}
+        if via_cloud:
+            self._update(str(user_id), downloads=lambda n: n + 1, cloud_uploads=lambda n: n + 1)
         else:
-            self.users[user_id]['downloads'] = self.users[user_id].get('downloads', 0) + 1
-            if via_cloud:
-                self.users[user_id]['cloud_uploads'] = self.users[user_id].get('cloud_uploads', 0) + 1
-        self.save_data()
+            self._update(str(user_id), downloads=lambda n: n + 1)
     
     def add_qr(self, user_id):
-        user_id = str(user_id)
-        if user_id not in self.users:
-            self.users[user_id] = {'pref': 'video', 'downloads': 0, 'qr': 1, 'cloud_uploads': 0}
-        else:
-            self.users[user_id]['qr'] = self.users[user_id].get('qr', 0) + 1
-        self.save_data()
+        self._update(str(user_id), qr=lambda n: n + 1)
     
     def get_stats(self, user_id):
         user_id = str(user_id)
@@ -251,7 +633,300 @@ class UserData:
 # Создаем глобальный экземпляр
 user_data = UserData()
 
+# ===================== КЭШ РЕЗУЛЬТАТОВ =====================
+# Параметры, которые не влияют на содержимое ссылки
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'igshid', 'igsh', 'is_from_webapp', 'sender_device', 'share_id', 'ref', '_r', '_t'}
+
+def normalize_url(url):
+    """Приводит ссылку к каноническому виду для ключей кэша"""
+    url = url.strip()
+    if '://' not in url:
+        url = 'https://' + url
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if host == 'twitter.com':
+        host = 'x.com'
+    path = parsed.path.rstrip('/') or '/'
+    query = [
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith('utm_')
+    ]
+    # youtu.be/<id> и youtube.com/shorts/<id> - то же видео, что и watch?v=<id>
+    if host == 'youtu.be':
+        host, query, path = 'youtube.com', [('v', path.strip('/'))] + query, '/watch'
+    elif host == 'youtube.com' and path.startswith('/shorts/'):
+        query, path = [('v', path.split('/')[2])] + query, '/watch'
+    return urlunparse(('https', host, path, '', urlencode(sorted(query)), ''))
+
+def platform_video_format(platform):
+    """Формат видео по умолчанию для платформы"""
+    return PLATFORM_VIDEO_FORMATS.get(platform, VIDEO_FORMAT)
+
+def mode_format(mode, platform=None):
+    """Строка формата, с которой скачивается режим"""
+    video = platform_video_format(platform)
+    audio = f"{AUDIO_FORMAT}>{AUDIO_CODEC}-{AUDIO_QUALITY}"
+    return {'video': video, 'audio': audio, 'all': f"{video}>{AUDIO_CODEC}-{AUDIO_QUALITY}+thumb"}.get(mode, mode)
+
+class TTLCache:
+    """LRU-кэш с временем жизни записей и счётчиками попаданий"""
+    
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # ключ -> (время истечения, значение)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key):
+        """Возвращает значение или None, если записи нет или она устарела"""
+        item = self._data.get(key)
+        if item is not None and item[0] is not None and time.time() >= item[0]:
+            del self._data[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+    
+    def set(self, key, value):
+        """Добавляет запись, вытесняя самые давно использованные"""
+        expires = time.time() + self.ttl if self.ttl else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+
+class ResultCache(TTLCache):
+    """
+    Постоянный кэш file_id уже отправленных результатов.
+    Как и UserData, пишется на диск в фоне: set/pop только отмечают изменения,
+    run_flusher сбрасывает их раз в RESULT_CACHE_FLUSH_INTERVAL секунд.
+    """
+    
+    def __init__(self, path, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.path = path
+        self._dirty = 0
+        self._flush_lock = asyncio.Lock()
+    
+    @staticmethod
+    def make_key(url, mode):
+        return f"{normalize_url(url)}|{mode}|{mode_format(mode, classify_url(url))}"
+    
+    def load_data(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    entries = json.load(f)
+                now = time.time()
+                for key, (expires, value) in entries:
+                    if expires is None or expires > now:
+                        self._data[key] = (expires, value)
+                logger.info(f"♻️ Загружено {len(self._data)} записей кэша результатов")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша результатов: {e}")
+            self._data = OrderedDict()
+    
+    async def flush(self):
+        """Сбрасывает кэш на диск в фоновом потоке, если он менялся"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            changes, self._dirty = self._dirty, 0
+            # Записи заменяются целиком, поэтому копии списка достаточно для снимка
+            snapshot = list(self._data.items())
+            write = asyncio.ensure_future(asyncio.to_thread(write_json_atomic, self.path, snapshot))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await write
+                raise
+            except Exception as e:
+                self._dirty += changes
+                logger.error(f"Ошибка сохранения кэша результатов: {e}")
+    
+    async def run_flusher(self):
+        """Фоновая задача: сбрасывает кэш по таймеру"""
+        while True:
+            await asyncio.sleep(RESULT_CACHE_FLUSH_INTERVAL)
+            await self.flush()
+    
+    def set(self, key, value):
+        super().set(key, value)
+        self._dirty += 1
+    
+    def pop(self, key):
+        value = super().pop(key)
+        if value is not None:
+            self._dirty += 1
+        return value
+
+# Создаем глобальный экземпляр
+result_cache = ResultCache(RESULT_CACHE_DB, RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+def sent_media(message):
+    """Достаёт тип и file_id из отправленного сообщения"""
+    if message.video:
+        return {'kind': 'video', 'file_id': message.video.file_id}
+    if message.audio:
+        return {'kind': 'audio', 'file_id': message.audio.file_id}
+    if message.photo:
+        return {'kind': 'photo', 'file_id': message.photo[-1].file_id}
+    if message.document:
+        return {'kind': 'document', 'file_id': message.document.file_id}
+    return None
+
+def media_kind(file_path):
+    """Как отправлять файл в Telegram: video, audio, photo или None"""
+    if file_path.endswith('.mp4'):
+        return 'video'
+    if file_path.endswith(('.mp3', '.m4a')):
+        return 'audio'
+    if file_path.endswith(('.jpg', '.jpeg', '.png', '.webp')):
+        return 'photo'
+    return None
+
+def telegram_size_limit(bot):
+    """Сколько байт можно отправить через Bot API, к которому подключен бот"""
+    return MAX_LOCAL_API_SIZE if bot.local_mode else MAX_TELEGRAM_SIZE
+
+def media_source(bot, file_path, files):
+    """
+    Что передать в reply_*/InputMedia* для файла с диска. Своему серверу Bot API
+    в local mode - путь (уйдёт как file://, сервер прочитает файл сам), облачному -
+    открытый файл для multipart; files - ExitStack, который его закроет.
+    """
+    if bot.local_mode:
+        return Path(file_path)
+    return files.enter_context(open(file_path, 'rb'))
+
+async def reply_media(message, kind, media):
+    """Отвечает файлом или file_id нужного типа"""
+    if kind == 'video':
+        return await message.reply_video(media, supports_streaming=True, caption="🎥 Видео готово!")
+    if kind == 'audio':
+        return await message.reply_audio(media, caption="🎵 Аудио готово!")
+    if kind == 'photo':
+        return await message.reply_photo(media, caption="📸 Обложка")
+    return await message.reply_document(media)
+
+async def send_cached_result(message, items):
+    """Отправляет результат из кэша по file_id, без скачивания и загрузки"""
+    for item in items:
+        await reply_media(message, item['kind'], item['file_id'])
+
 # ===================== YANDEX.DISK ФУНКЦИИ =====================
+class YandexUploader:
+    """Неблокирующая загрузка на Яндекс.Диск в отдельном пуле потоков"""
+    
+    def __init__(self, workers, chunk_size):
+        self.chunk_size = chunk_size
+        # Потоки живут долго, а yadisk держит по requests.Session на поток,
+        # поэтому HTTP-соединения с API переиспользуются между загрузками
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="harti-ya")
+        self._folder_ready = False
+        self._folder_lock = asyncio.Lock()
+        self.active = 0
+        self.bytes_uploaded = 0
+        self.seconds_uploading = 0.0
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполняет синхронный вызов yadisk в пуле загрузчика"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+    
+    async def ensure_folder(self):
+        """Создаёт папку на диске один раз за время работы бота"""
+        if self._folder_ready:
+            return
+        from yadisk.exceptions import PathExistsError
+        
+        async with self._folder_lock:
+            if self._folder_ready:
+                return
+            try:
+                await self.run(YANDEX_DISK_CLIENT.mkdir, YANDEX_FOLDER)
+                logger.info(f"📁 Создана папка {YANDEX_FOLDER} на Яндекс.Диске")
+            except PathExistsError:
+                pass
+            self._folder_ready = True
+    
+    def _upload_sync(self, file_path, yandex_path):
+        """Потоково отправляет файл кусками по chunk_size и публикует его"""
+        def chunks():
+            with open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        
+        YANDEX_DISK_CLIENT.upload(chunks, yandex_path)
+        YANDEX_DISK_CLIENT.publish(yandex_path)
+        return YANDEX_DISK_CLIENT.get_meta(yandex_path, fields=['public_url']).public_url
+    
+    async def upload(self, file_path, yandex_path):
+        """Загружает файл и возвращает публичную ссылку"""
+        await self.ensure_folder()
+        size = os.path.getsize(file_path)
+        self.active += 1
+        started = time.monotonic()
+        try:
+            public_url = await self.run(self._upload_sync, file_path, yandex_path)
+        finally:
+            self.active -= 1
+        elapsed = time.monotonic() - started
+        UPLOADED_BYTES.labels('yandex').inc(size)
+        yandex_throughput.observe(size, elapsed)
+        self.bytes_uploaded += size
+        self.seconds_uploading += elapsed
+        logger.info(
+            f"📤 Загружено {size / 1024 / 1024:.1f} МБ за {elapsed:.1f} с "
+            f"({size / 1024 / 1024 / max(elapsed, 1e-6):.1f} МБ/с, параллельно: {self.active + 1})"
+        )
+        return public_url
+
+# Создаем глобальный экземпляр
+yandex_uploader = YandexUploader(YANDEX_UPLOAD_WORKERS, YANDEX_CHUNK_SIZE)
+
+def create_yandex_client():
+    import yadisk
+    return yadisk.Client(token=YANDEX_DISK_TOKEN)
+
+async def connect_yandex():
+    """
+    Создаёт клиент Яндекс.Диска и проверяет токен, когда бот уже принимает апдейты,
+    затем запускает планировщик удаления (его первый проход ходит в API диска)
+    """
+    global YANDEX_DISK_CLIENT
+    if YANDEX_DISK_TOKEN:
+        try:
+            client = await yandex_uploader.run(create_yandex_client)
+            if await yandex_uploader.run(client.check_token):
+                YANDEX_DISK_CLIENT = client
+                logger.info("✅ Yandex.Disk клиент успешно создан и токен валиден")
+            else:
+                logger.error("❌ Токен Yandex.Disk невалиден")
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания Yandex.Disk клиента: {e}")
+    else:
+        logger.info("⚠️ Yandex.Disk не настроен (переменная YANDEX_DISK_TOKEN отсутствует)")
+    # Файлы удаляет один процесс: воркеры только записывают их в общую базу
+    if BOT_ROLE != 'worker':
+        await file_manager.run_scheduler()
+
 async def upload_to_yandex(file_path, filename=None, user_id=None, chat_id=None):
     """
     Загружает файл на Yandex.Disk и возвращает публичную ссылку
@@ -266,26 +941,12 @@ async def upload_to_yandex(file_path, filename=None, user_id=None, chat_id=None)
         safe_filename = filename or os.path.basename(file_path)
         # Очищаем имя файла от недопустимых символов
         safe_filename = "".join(c for c in safe_filename if c.isalnum() or c in " ._-()").strip()
-        yandex_path = f"/HartiDash/{timestamp}_{safe_filename}"
+        # Короткий случайный префикс: одинаковые файлы в одну секунду не перезапишут друг друга
+        yandex_path = f"{YANDEX_FOLDER}/{timestamp}_{uuid.uuid4().hex[:8]}_{safe_filename}"
         
         logger.info(f"📤 Загружаю на Yandex.Disk: {yandex_path}")
-        
-        # Используем контекстный менеджер для работы с клиентом
-        with YANDEX_DISK_CLIENT:
-            # Создаём папку HartiDash, если её нет
-            if not YANDEX_DISK_CLIENT.exists("/HartiDash"):
-                YANDEX_DISK_CLIENT.mkdir("/HartiDash")
-                logger.info("📁 Создана папка /HartiDash на Яндекс.Диске")
-            
-            # Загружаем файл [citation:5][citation:9]
-            YANDEX_DISK_CLIENT.upload(file_path, yandex_path)
-            logger.info(f"✅ Файл загружен на Yandex.Disk")
-            
-            # Делаем файл публичным и получаем ссылку [citation:5]
-            publication = YANDEX_DISK_CLIENT.publish(yandex_path)
-            # Получаем публичную ссылку
-            public_url = YANDEX_DISK_CLIENT.get_public_link(yandex_path)
-            logger.info(f"🔗 Публичная ссылка получена")
+        public_url = await yandex_uploader.upload(file_path, yandex_path)
+        logger.info(f"🔗 Публичная ссылка получена")
         
         # Сохраняем информацию о файле
         delete_time = file_manager.add_file(
@@ -301,160 +962,1405 @@ async def upload_to_yandex(file_path, filename=None, user_id=None, chat_id=None)
         return public_url, delete_time_formatted
         
     except Exception as e:
+        FAILURES.labels('yandex_upload').inc()
         logger.error(f"❌ Ошибка загрузки на Yandex.Disk: {e}")
         import traceback
         logger.error(traceback.format_exc())
         return None, None
 
+# ===================== МОНИТОРИНГ EVENT LOOP =====================
+class LoopLagMonitor:
+    """Меряет, насколько event loop опаздывает с пробуждением корутин"""
+    
+    def __init__(self, interval=0.5, report_every=60):
+        self.interval = interval
+        self.report_every = report_every
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+    
+    async def run(self):
+        last_report = time.monotonic()
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, time.monotonic() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            if self.last_lag >= LOOP_LAG_WARNING:
+                logger.warning(f"🐢 Event loop опоздал на {self.last_lag * 1000:.0f} мс")
+            if started - last_report >= self.report_every:
+                logger.info(
+                    f"⏱ Макс. задержка event loop: {self.max_lag * 1000:.0f} мс, "
+                    f"загрузок на диск в работе: {yandex_uploader.active}"
+                )
+                self.max_lag = 0.0
+                last_report = started
+
+# Создаем глобальный экземпляр
+loop_lag_monitor = LoopLagMonitor()
+
+# ===================== ВРЕМЕННЫЕ ПАПКИ ЗАДАЧ =====================
+def dir_size(path):
+    """Сколько байт занимают файлы в папке"""
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def clear_dir(path):
+    """Удаляет всё содержимое папки, саму папку оставляет"""
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+class TempSpace:
+    """
+    Папки задач harti_* во временной директории.
+    Выдаёт уникальные папки, учитывает занятое ими место для квоты,
+    удаляет папки по окончании задачи и убирает брошенные (после падения процесса).
+    """
+    
+    PREFIX = 'harti_'
+    
+    def __init__(self, root, quota, min_free):
+        self.root = root
+        self.quota = quota
+        self.min_free = min_free
+        self._dirs = {}  # папка -> байт (0, пока идёт скачивание)
+        self.listeners = []  # вызываются, когда место освободилось
+        self.reclaimed = 0
+    
+    @property
+    def held(self):
+        """Байт в папках готовых скачиваний, которые ещё отправляются"""
+        return sum(self._dirs.values())
+    
+    def disk_free(self):
+        return shutil.disk_usage(self.root).free
+    
+    def fits(self, extra):
+        """Поместятся ли ещё extra байт в квоту и на диск"""
+        return self.held + extra <= self.quota and self.disk_free() - extra >= self.min_free
+    
+    def create(self):
+        """Новая уникальная папка задачи"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        while True:
+            # Случайный суффикс: задачи одной секунды не смешиваются. Папка попадает
+            # в _dirs до того, как появится на диске, иначе reclaim из другого
+            # потока может успеть принять её за брошенную
+            path = os.path.join(self.root, f"{self.PREFIX}{timestamp}_{uuid.uuid4().hex[:8]}")
+            self._dirs[path] = 0
+            try:
+                os.mkdir(path, 0o700)
+                return path
+            except FileExistsError:
+                self._dirs.pop(path, None)
+            except BaseException:
+                self._dirs.pop(path, None)
+                raise
+    
+    def settle(self, path):
+        """Скачивание закончилось: запоминаем реальный размер папки"""
+        if path in self._dirs:
+            self._dirs[path] = dir_size(path)
+    
+    def remove(self, path):
+        """Удаляет папку задачи и сообщает, что место освободилось"""
+        if not path:
+            return
+        shutil.rmtree(path, ignore_errors=True)
+        if self._dirs.pop(path, None) is not None:
+            for listener in self.listeners:
+                listener()
+    
+    def _scan(self):
+        for entry in os.scandir(self.root):
+            if entry.name.startswith(self.PREFIX) and entry.is_dir(follow_symlinks=False):
+                yield entry
+    
+    def usage(self):
+        """Сколько байт занимают все папки harti_*, включая брошенные"""
+        return sum(dir_size(entry.path) for entry in self._scan())
+    
+    def reclaim(self, max_age):
+        """Удаляет чужие папки harti_* старше max_age секунд, возвращает освобождённые байты"""
+        freed = 0
+        now = time.time()
+        for entry in list(self._scan()):
+            if entry.path in self._dirs:
+                continue
+            try:
+                if now - entry.stat(follow_symlinks=False).st_mtime < max_age:
+                    continue
+            except OSError:
+                continue
+            freed += dir_size(entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+            self.reclaimed += 1
+        return freed
+    
+    async def run_reclaimer(self):
+        """
+        Убирает брошенные папки старше TEMP_ORPHAN_AGE. Общий TMPDIR могут делить
+        другие процессы бота на этой машине, поэтому все папки сразу при запуске
+        удаляются, только если TMPDIR принадлежит одному процессу (TEMP_DIR_PRIVATE=1)
+        """
+        max_age = 0 if TEMP_DIR_PRIVATE else TEMP_ORPHAN_AGE
+        while True:
+            try:
+                freed = await asyncio.to_thread(self.reclaim, max_age)
+                if freed:
+                    logger.info(f"🧹 Удалены брошенные временные папки: {format_size(freed)}")
+                    for listener in self.listeners:
+                        listener()
+            except Exception as e:
+                logger.error(f"❌ Ошибка уборки временных папок: {e}")
+            max_age = TEMP_ORPHAN_AGE
+            await asyncio.sleep(TEMP_RECLAIM_INTERVAL)
+
+# Создаем глобальный экземпляр
+temp_space = TempSpace(TEMP_DIR, TEMP_QUOTA, TEMP_MIN_FREE)
+
+# ===================== ПУЛ ВОРКЕРОВ СКАЧИВАНИЯ =====================
+class _Waiter:
+    """Задача в очереди за слотом воркера"""
+    __slots__ = ('user_id', 'est_bytes', 'future', 'on_position', 'position')
+    
+    def __init__(self, user_id, est_bytes, on_position):
+        self.user_id = user_id
+        self.est_bytes = est_bytes
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = None
+
+class DownloadPool:
+    """
+    Глобальный пул воркеров скачивания с очередью.
+    Допуск: не больше per_user задач на пользователя и max_queue в очереди.
+    Выдача слотов идёт по кругу между пользователями, с лимитами на число
+    одновременных скачиваний пользователя, на оценку байт в работе и
+    (если передан space) на место во временной директории.
+    """
+    
+    def __init__(self, workers, per_user, running_per_user=MAX_RUNNING_PER_USER,
+                 max_queue=MAX_QUEUE, max_bytes=MAX_BYTES_IN_FLIGHT, space=None):
+        self.workers = workers
+        self.per_user = per_user
+        self.running_per_user = running_per_user
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes
+        self.space = space
+        if space:
+            # Задача отправлена и её папка удалена - ожидающим может хватить места
+            space.listeners.append(self._dispatch)
+        # Отдельный executor, чтобы yt-dlp не занимал общий пул потоков event loop
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="harti-dl")
+        self._queues = OrderedDict()  # пользователь -> очередь; порядок ключей - порядок обхода
+        self._running = {}
+        self._user_jobs = {}
+        # Счётчики меняет только event loop; метрики читают их из другого потока,
+        # поэтому им не нужно обходить _queues
+        self.waiting = 0
+        self.in_flight = 0
+        self.bytes_in_flight = 0
+        self.avg_job_seconds = 30.0  # скользящее среднее длительности скачивания
+    
+    def user_jobs(self, user_id):
+        """Сколько задач пользователя сейчас в очереди или в работе"""
+        return self._user_jobs.get(str(user_id), 0)
+    
+    def admit_error(self, user_id):
+        """Причина отказа в приёме задачи: 'user', 'busy', 'disk' или None"""
+        if self.user_jobs(user_id) >= self.per_user:
+            return 'user'
+        if self.waiting >= self.max_queue:
+            return 'busy'
+        # Диск занят не нами: ждать освобождения места бессмысленно
+        if self.space and not self.in_flight and not self.space.held and not self.space.fits(0):
+            return 'disk'
+        return None
+    
+    def can_accept(self, user_id):
+        """Можно ли принять ещё одну задачу от пользователя"""
+        return self.admit_error(user_id) is None
+    
+    def eta(self, position):
+        """Примерное ожидание в секундах для места в очереди"""
+        return -(-position // self.workers) * self.avg_job_seconds
+    
+    def _fits(self, waiter, strict=True):
+        if strict and self._running.get(waiter.user_id, 0) >= self.running_per_user:
+            return False
+        # Одна большая задача проходит всегда, иначе она бы ждала вечно
+        if self.bytes_in_flight and self.bytes_in_flight + waiter.est_bytes > self.max_bytes:
+            return False
+        # Место на диске: ждём, пока освободят свои же задачи, если им есть что освобождать
+        if self.space and (self.in_flight or self.space.held):
+            return self.space.fits(self.bytes_in_flight + waiter.est_bytes)
+        return True
+    
+    def _pick(self, strict):
+        for user_id, queue in self._queues.items():
+            if self._fits(queue[0], strict):
+                return user_id
+        return None
+    
+    def _dispatch(self):
+        """
+        Раздаёт свободные слоты по кругу между пользователями. Лимит
+        running_per_user действует, пока есть кто-то ещё: иначе свободные
+        воркеры достаются задачам того же пользователя (ссылки одного сообщения)
+        """
+        while self.in_flight < self.workers:
+            user_id = self._pick(strict=True)
+            if user_id is None:
+                user_id = self._pick(strict=False)
+            if user_id is None:
+                break
+            queue = self._queues[user_id]
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self.in_flight += 1
+            self.bytes_in_flight += waiter.est_bytes
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            waiter.future.set_result(None)
+        self._notify_positions()
+    
+    def _notify_positions(self):
+        """Сообщает ожидающим их место: по одной задаче от пользователя за круг"""
+        queues = list(self._queues.values())
+        depth = max((len(queue) for queue in queues), default=0)
+        position = 0
+        for level in range(depth):
+            for queue in queues:
+                if level < len(queue):
+                    position += 1
+                    waiter = queue[level]
+                    if waiter.position != position:
+                        waiter.position = position
+                        if waiter.on_position:
+                            waiter.on_position(position, self.eta(position))
+    
+    def _release(self, waiter, granted, elapsed):
+        if granted:
+            self.in_flight -= 1
+            self.bytes_in_flight -= waiter.est_bytes
+            self._running[waiter.user_id] -= 1
+            if self._running[waiter.user_id] <= 0:
+                del self._running[waiter.user_id]
+            if elapsed is not None:
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+        else:
+            queue = self._queues.get(waiter.user_id)
+            if queue and waiter in queue:
+                queue.remove(waiter)
+                self.waiting -= 1
+                if not queue:
+                    del self._queues[waiter.user_id]
+        self._user_jobs[waiter.user_id] -= 1
+        if self._user_jobs[waiter.user_id] <= 0:
+            del self._user_jobs[waiter.user_id]
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, user_id, est_bytes=None, on_position=None):
+        """
+        Занимает слот воркера на время скачивания, отдаёт заявку для update_estimate.
+        on_position(место, секунд ожидания) вызывается, пока задача в очереди.
+        """
+        user_id = str(user_id)
+        waiter = _Waiter(user_id, est_bytes or MAX_TELEGRAM_SIZE, on_position)
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self.waiting += 1
+        self._dispatch()
+        started = None
+        try:
+            await waiter.future
+            started = time.monotonic()
+            yield waiter
+        finally:
+            # Слот могли выдать в момент отмены, до того как задача проснулась
+            granted = waiter.future.done() and not waiter.future.cancelled()
+            self._release(waiter, granted, time.monotonic() - started if started else None)
+    
+    def update_estimate(self, waiter, est_bytes):
+        """Уточняет оценку байт задачи, которая уже получила слот (по проверке перед скачиванием)"""
+        if not est_bytes or est_bytes == waiter.est_bytes:
+            return
+        self.bytes_in_flight += est_bytes - waiter.est_bytes
+        waiter.est_bytes = est_bytes
+        # Оценка уменьшилась - ожидающим может хватить лимита байт
+        self._dispatch()
+    
+    async def run(self, func, *args):
+        """Выполняет блокирующую функцию в потоках пула"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+# Создаем глобальный экземпляр
+download_pool = DownloadPool(DOWNLOAD_WORKERS, MAX_JOBS_PER_USER, space=temp_space)
+
+# ===================== ПРОЦЕССЫ YT-DLP =====================
+YTDLP_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ytdlp_worker.py')
+YTDLP_MESSAGE_LIMIT = 64 * 1024 * 1024  # максимальная строка протокола (info большого плейлиста)
+YTDLP_TEMP_SUFFIXES = ('.part', '.ytdl', '.temp')  # недокачанные и служебные файлы yt-dlp
+
+class YtdlpError(Exception):
+    """Ошибка yt-dlp в процессе-воркере или таймаут скачивания"""
+
+class YtdlpTimeout(YtdlpError):
+    """Скачивание не уложилось в DOWNLOAD_TIMEOUT"""
+
+class _YtdlpProcess:
+    """Один процесс ytdlp_worker.py"""
+    
+    def __init__(self, process):
+        self.process = process
+    
+    @classmethod
+    async def start(cls):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, YTDLP_WORKER,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=YTDLP_MESSAGE_LIMIT,
+        )
+        worker = cls(process)
+        await worker.read()  # воркер импортировал yt-dlp и готов
+        return worker
+    
+    @property
+    def alive(self):
+        return self.process.returncode is None
+    
+    async def send(self, request):
+        self.process.stdin.write((json.dumps(request) + '\n').encode())
+        await self.process.stdin.drain()
+    
+    async def read(self):
+        line = await self.process.stdout.readline()
+        if not line:
+            raise YtdlpError("Процесс yt-dlp неожиданно завершился")
+        return json.loads(line)
+    
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+    
+    async def stop(self):
+        """Закрывает stdin (воркер выходит из цикла сам) и дожидается процесса"""
+        if self.alive:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+
+class YtdlpProcessPool:
+    """
+    Пул процессов yt-dlp: разбор страниц и скачивание идут на других ядрах
+    и не отнимают GIL у event loop. Процессы запускаются по мере надобности и
+    переиспользуются; при отмене задачи или таймауте процесс убивается,
+    вместо него позже запустится новый.
+    """
+    
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+        self._ids = 0
+    
+    async def _take(self):
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.alive:
+                return worker
+        return await _YtdlpProcess.start()
+    
+    async def prestart(self, profiles=()):
+        """
+        Запускает один процесс заранее и создаёт в нём YoutubeDL для profiles,
+        чтобы первое скачивание не ждало импорта и настройки yt-dlp
+        """
+        async with self._slots:
+            if not self._idle:
+                worker = await _YtdlpProcess.start()
+                for opts in profiles:
+                    self._ids += 1
+                    await self._exchange(worker, {'id': self._ids, 'action': 'warm', 'url': None, 'opts': opts}, (), ())
+                self._idle.append(worker)
+    
+    async def _exchange(self, worker, request, progress_hooks, postprocessor_hooks):
+        await worker.send(request)
+        while True:
+            message = await worker.read()
+            if message['event'] == 'progress':
+                for hook in progress_hooks:
+                    hook(message['data'])
+            elif message['event'] == 'postprocessor':
+                for hook in postprocessor_hooks:
+                    hook(message['data'])
+            else:
+                return message
+    
+    async def run(self, action, url, opts, progress_hooks=(), postprocessor_hooks=(), info=None):
+        """
+        Выполняет в процессе yt-dlp действие 'download', 'extract' (скачать
+        и вернуть info) или 'probe' (только info) с опциями opts. Готовый info
+        из прошлого probe избавляет от повторного разбора страницы.
+        Хуки вызываются в event loop.
+        """
+        self._ids += 1
+        request = {'id': self._ids, 'action': action, 'url': url, 'opts': opts, 'info': info}
+        async with self._slots:
+            worker = await self._take()
+            try:
+                message = await asyncio.wait_for(
+                    self._exchange(worker, request, progress_hooks, postprocessor_hooks), self.timeout
+                )
+            except asyncio.TimeoutError:
+                worker.kill()
+                FAILURES.labels('timeout').inc()
+                raise YtdlpTimeout(f"yt-dlp не уложился в {self.timeout} с")
+            except BaseException:
+                # Отмена или сломанный протокол: в процессе могла остаться недокачанная задача
+                worker.kill()
+                raise
+            self._idle.append(worker)
+        if message['event'] == 'error':
+            raise YtdlpError(message['error'])
+        return message['result']
+    
+    async def close(self):
+        # Дожидаемся процессов, иначе их транспорты закрываются уже после остановки event loop
+        workers, self._idle = self._idle, []
+        await asyncio.gather(*(worker.stop() for worker in workers))
+
+# Создаем глобальный экземпляр
+ytdlp_processes = YtdlpProcessPool(DOWNLOAD_PROCESSES, DOWNLOAD_TIMEOUT)
+
 # ===================== ФУНКЦИИ СКАЧИВАНИЯ =====================
-async def download_video(url, mode='video'):
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+async def run_ffmpeg(src_path, dst_path, *args):
+    """Запускает ffmpeg для одного файла; при ошибке удаляет недописанный результат"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-y', '-loglevel', 'error', '-i', src_path, *args, dst_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except FileNotFoundError:
+        logger.error("❌ ffmpeg не найден")
+        return False
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        logger.error(f"❌ ffmpeg завершился с ошибкой: {stderr.decode(errors='ignore')[:300]}")
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        return False
+    return True
+
+async def shrink_videos(out_path, video_kbps, budget):
+    """
+    Перекодирует скачанные видео больше budget байт в H.264 с битрейтом
+    video_kbps (ограничен -maxrate, чтобы размер не уплыл) и AAC; файл заменяется.
+    """
+    for name in os.listdir(out_path):
+        path = os.path.join(out_path, name)
+        if media_kind(path) != 'video' or os.path.getsize(path) <= budget:
+            continue
+        tmp_path = os.path.join(out_path, f"shrunk.{name}")
+        if await run_ffmpeg(
+            path, tmp_path,
+            '-c:v', 'libx264', '-preset', 'veryfast',
+            '-b:v', f"{video_kbps}k", '-maxrate', f"{video_kbps}k", '-bufsize', f"{video_kbps * 2}k",
+            '-c:a', 'aac', '-b:a', f"{REENCODE_AUDIO_KBPS}k", '-movflags', '+faststart',
+        ):
+            os.replace(tmp_path, path)
+
+async def extract_audio(src_path, dst_path, source_codec=None):
+    """
+    Извлекает звуковую дорожку из уже скачанного файла через ffmpeg.
+    При AUDIO_POLICY=copy AAC-дорожка (source_codec из info, mp4a...) копируется
+    без перекодирования; неизвестный кодек пробуем скопировать, и только если
+    не вышло - перекодируем.
+    """
+    if AUDIO_POLICY != 'mp3' and (source_codec is None or source_codec.startswith('mp4a')):
+        if await run_ffmpeg(src_path, dst_path, '-vn', '-codec:a', 'copy'):
+            return True
+        logger.info("Дорожку не удалось скопировать как есть, перекодирую")
+    encoder = 'libmp3lame' if AUDIO_CODEC == 'mp3' else 'aac'
+    return await run_ffmpeg(src_path, dst_path, '-vn', '-codec:a', encoder, '-b:a', f"{AUDIO_QUALITY}k")
+
+COOKIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cookies.txt')
+
+def build_ytdlp_options():
+    """
+    Общие опции yt-dlp. Собираются один раз при запуске: опции задачи - это
+    копия с добавленными outtmpl и format. По ним процессы-воркеры держат
+    готовые экземпляры YoutubeDL (см. ytdlp_worker.py), поэтому опции,
+    кроме outtmpl, format и merge_output_format, должны быть одинаковыми у всех
+    задач одного режима.
+    """
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'nocheckcertificate': True,
+        # Плейлисты разворачиваются заранее (expand_playlist), здесь - всегда одно видео
+        'noplaylist': True,
+        'user_agent': USER_AGENT,
+        'headers': {
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-us,en;q=0.5',
+            'Accept-Encoding': 'gzip, deflate',
+            'Sec-Fetch-Mode': 'navigate',
+        },
+    }
+    
+    if os.path.exists(COOKIES_FILE):
+        # Воркеры читают файл один раз и никогда не закрывают YoutubeDL,
+        # поэтому yt-dlp не перезаписывает общий файл
+        opts['cookiefile'] = COOKIES_FILE
+        logger.info("🍪 Файл cookies найден и будет использован")
+    else:
+        logger.info("🍪 Файл cookies не найден, продолжаем без него")
+    return opts
+
+# Собираются в on_startup (init_ytdlp_options): проверка cookies не выполняется при импорте
+YTDLP_OPTIONS = None
+YTDLP_PROFILES = None
+
+# Опции экстрактора по платформам (формат - в PLATFORM_VIDEO_FORMATS);
+# direct - прямые ссылки и всё, что пришло без платформы
+PLATFORM_OPTIONS = {
+    'youtube': {
+        # Клиенты, которые отдают готовые mp4; hls и dash формату всё равно не подходят
+        'extractor_args': {'youtube': {'player_client': ['android', 'web'], 'skip': ['hls', 'dash']}},
+    },
+    'tiktok': {'http_headers': {'Referer': 'https://www.tiktok.com/'}},
+    'instagram': {},
+    'facebook': {},
+    'x': {},
+    'direct': {},
+}
+
+def build_ytdlp_profiles(base_opts):
+    """
+    Профили опций по платформе и режиму ('all' качает видео профилем 'video');
+    воркеры держат по готовому YoutubeDL на профиль
+    """
+    return {
+        (platform, profile): dict(base_opts, **platform_opts, **profile_opts)
+        for platform, platform_opts in PLATFORM_OPTIONS.items()
+        for profile, profile_opts in (
+            ('video', {}),
+            # Для m4a yt-dlp копирует AAC-дорожку (-c copy) и перекодирует только другие кодеки
+            ('audio', {'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': AUDIO_CODEC,
+                'preferredquality': AUDIO_QUALITY,
+            }]}),
+        )
+    }
+
+def init_ytdlp_options():
+    """Собирает общие опции и профили yt-dlp (вызывается из on_startup)"""
+    global YTDLP_OPTIONS, YTDLP_PROFILES
+    YTDLP_OPTIONS = build_ytdlp_options()
+    YTDLP_PROFILES = build_ytdlp_profiles(YTDLP_OPTIONS)
+
+def ytdlp_options(platform, profile='video', **job_opts):
+    """Опции yt-dlp для одной задачи: профиль платформы плюс outtmpl, format и merge_output_format задачи"""
+    if platform not in PLATFORM_OPTIONS:
+        platform = 'direct'
+    return dict(YTDLP_PROFILES[(platform, profile)], **job_opts)
+
+def fetch_thumbnail(thumbnail_url, out_path):
+    """Скачивает обложку по ссылке из info['thumbnail']"""
+    import requests
+    
+    response = requests.get(thumbnail_url, headers={'User-Agent': USER_AGENT}, timeout=15)
+    response.raise_for_status()
+    ext = os.path.splitext(urlparse(thumbnail_url).path)[1].lstrip('.').lower()
+    if ext not in ('jpg', 'jpeg', 'png', 'webp'):
+        ext = 'jpg'
+    path = os.path.join(out_path, f"thumbnail.{ext}")
+    with open(path, 'wb') as f:
+        f.write(response.content)
+    return path
+
+async def download_video(url, mode='video', progress=None, known_info=None, plan=None):
     """
     Скачивает видео/аудио с любой платформы
     mode: 'video', 'audio', 'all'
+    progress: JobProgress, получает хуки yt-dlp
+    known_info: info из проверки перед скачиванием (preflight), страница заново не разбирается
+    plan: план из plan_download - формат под лимит Telegram или перекодирование
     """
+    plan = plan or {}
+    out_path = None
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        out_path = os.path.join(TEMP_DIR, f"harti_{timestamp}")
-        os.makedirs(out_path, exist_ok=True)
+        out_path = temp_space.create()
         
         files = []
         logger.info(f"📥 Скачиваю {mode} с {url}")
         
-        base_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'nocheckcertificate': True,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'headers': {
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate',
-                'Sec-Fetch-Mode': 'navigate',
-            },
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['android', 'web'],
-                    'skip': ['hls', 'dash'],
-                }
-            }
-        }
-        
-        cookies_file = os.path.join(os.path.dirname(__file__), 'cookies.txt')
-        if os.path.exists(cookies_file):
-            base_opts['cookiefile'] = cookies_file
-            logger.info("🍪 Файл cookies найден и будет использован")
-        else:
-            logger.info("🍪 Файл cookies не найден, продолжаем без него")
+        platform = detect_platform(url)
+        video_format = plan.get('format') or platform_video_format(platform)
+        # Пара видео+аудио из plan_format склеивается в mp4
+        merge = {'merge_output_format': 'mp4'} if '+' in video_format else {}
+        
+        metrics = DownloadMetrics(platform, mode)
+        progress_hooks = [metrics.download_hook]
+        postprocessor_hooks = [metrics.postprocessor_hook]
+        if progress:
+            progress_hooks.append(progress.download_hook)
+            postprocessor_hooks.append(progress.postprocessor_hook)
+        
+        async def run_ytdlp(action, opts):
+            if known_info is not None:
+                try:
+                    return await ytdlp_processes.run(
+                        action, url, opts, progress_hooks, postprocessor_hooks, info=known_info
+                    )
+                except YtdlpTimeout:
+                    raise
+                except YtdlpError as e:
+                    # Ссылки на форматы в сохранённом info могли истечь - разбираем страницу заново
+                    logger.warning(f"⚠️ Не скачалось по сохранённому info, разбираю ссылку заново: {e}")
+                    info_cache.pop(info_cache_key(url, mode))
+                    # Недокачанные .part/.ytdl первой попытки не должны попасть в результат
+                    clear_dir(out_path)
+            return await ytdlp_processes.run(action, url, opts, progress_hooks, postprocessor_hooks)
         
         if mode == 'video':
-            ydl_opts = base_opts.copy()
-            ydl_opts.update({
-                'outtmpl': os.path.join(out_path, '%(title)s.%(ext)s'),
-                'format': 'best[ext=mp4]/best',
-            })
+            ydl_opts = ytdlp_options(
+                platform, 'video',
+                outtmpl=os.path.join(out_path, '%(title)s.%(ext)s'),
+                format=video_format,
+                **merge,
+            )
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                await asyncio.get_event_loop().run_in_executor(
-                    None, lambda: ydl.download([url])
-                )
+            await run_ytdlp('download', ydl_opts)
         
         elif mode == 'audio':
-            ydl_opts = base_opts.copy()
-            ydl_opts.update({
-                'outtmpl': os.path.join(out_path, '%(title)s.%(ext)s'),
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            })
+            ydl_opts = ytdlp_options(
+                platform, 'audio',
+                outtmpl=os.path.join(out_path, '%(title)s.%(ext)s'),
+                format=plan.get('format') or AUDIO_FORMAT,
+            )
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                await asyncio.get_event_loop().run_in_executor(
-                    None, lambda: ydl.download([url])
-                )
+            await run_ytdlp('download', ydl_opts)
         
         elif mode == 'all':
-            video_opts = base_opts.copy()
-            video_opts.update({
-                'outtmpl': os.path.join(out_path, 'video.%(ext)s'),
-                'format': 'best[ext=mp4]/best',
-            })
-            
-            with yt_dlp.YoutubeDL(video_opts) as ydl:
-                await asyncio.get_event_loop().run_in_executor(
-                    None, lambda: ydl.download([url])
-                )
+            # Одно извлечение: видео качаем, аудио и обложку получаем из него
+            video_opts = ytdlp_options(
+                platform, 'video',
+                outtmpl=os.path.join(out_path, 'video.%(ext)s'),
+                format=video_format,
+                **merge,
+            )
             
-            audio_opts = base_opts.copy()
-            audio_opts.update({
-                'outtmpl': os.path.join(out_path, 'audio.%(ext)s'),
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            })
+            info = await run_ytdlp('extract', video_opts)
             
-            with yt_dlp.YoutubeDL(audio_opts) as ydl:
-                await asyncio.get_event_loop().run_in_executor(
-                    None, lambda: ydl.download([url])
-                )
+            if plan.get('video_kbps'):
+                if progress:
+                    progress.phase("🗜 *Сжимаю видео под лимит Telegram...*")
+                await shrink_videos(out_path, plan['video_kbps'], plan['budget'])
+            video_path = next(
+                (os.path.join(out_path, f) for f in os.listdir(out_path) if f.startswith('video.')),
+                None
+            )
+            if video_path:
+                audio_path = os.path.join(out_path, f"audio.{AUDIO_CODEC}")
+                if progress:
+                    progress.phase("🎵 *Извлекаю аудио...*")
+                started = time.monotonic()
+                if await extract_audio(video_path, audio_path, (info or {}).get('acodec')):
+                    metrics.observe('postprocess', time.monotonic() - started)
+                else:
+                    logger.info("Аудио не извлеклось из видео")
             
-            try:
-                thumb_opts = base_opts.copy()
-                thumb_opts.update({
-                    'outtmpl': os.path.join(out_path, 'thumbnail.%(ext)s'),
-                    'writethumbnail': True,
-                    'skip_download': True,
-                })
-                
-                with yt_dlp.YoutubeDL(thumb_opts) as ydl:
-                    await asyncio.get_event_loop().run_in_executor(
-                        None, lambda: ydl.download([url])
-                    )
-            except Exception as e:
-                logger.info(f"Обложка не скачалась: {e}")
+            thumbnail_url = (info or {}).get('thumbnail')
+            if thumbnail_url:
+                try:
+                    await download_pool.run(fetch_thumbnail, thumbnail_url, out_path)
+                except Exception as e:
+                    logger.info(f"Обложка не скачалась: {e}")
+        
+        if mode == 'video' and plan.get('video_kbps'):
+            if progress:
+                progress.phase("🗜 *Сжимаю видео под лимит Telegram...*")
+            await shrink_videos(out_path, plan['video_kbps'], plan['budget'])
         
         if os.path.exists(out_path):
             for f in os.listdir(out_path):
+                # Служебные и недокачанные файлы yt-dlp не отправляем
+                if f.startswith('.') or f.endswith(YTDLP_TEMP_SUFFIXES) or '.part-Frag' in f:
+                    continue
                 file_path = os.path.join(out_path, f)
                 files.append(file_path)
                 logger.info(f"✅ Скачан файл: {f}")
         
+        temp_space.settle(out_path)
         return files, out_path
         
     except Exception as e:
+        FAILURES.labels('download').inc()
         logger.error(f"❌ ОШИБКА СКАЧИВАНИЯ: {e}")
         import traceback
         logger.error(traceback.format_exc())
+        temp_space.remove(out_path)
         return None, None
+    except asyncio.CancelledError:
+        temp_space.remove(out_path)
+        raise
+
+# ===================== НАРЕЗКА И ВЫБОР ДОСТАВКИ =====================
+class Throughput:
+    """Скользящая оценка скорости (байт/с) по последним замерам"""
+    
+    def __init__(self, initial, weight=0.3):
+        self.rate = initial
+        self.weight = weight
+    
+    def observe(self, size, seconds):
+        if size > 0 and seconds > 0:
+            self.rate += self.weight * (size / seconds - self.rate)
+    
+    def eta(self, size):
+        return size / self.rate
+
+# Создаем глобальные экземпляры
+telegram_throughput = Throughput(TELEGRAM_RATE_ESTIMATE)
+yandex_throughput = Throughput(YANDEX_RATE_ESTIMATE)
+split_throughput = Throughput(SPLIT_RATE_ESTIMATE)
+
+def split_parts_needed(size, limit):
+    return -(-size // int(limit * SPLIT_PART_FILL))
+
+def choose_delivery(bot, size, kind):
+    """
+    Как доставить файл размером size: 'telegram' - целиком, 'split' - частями
+    альбомом, 'cloud' - ссылкой на Яндекс.Диск, 'too_large' - никак.
+    Если годится и нарезка, и облако, сравнивает ожидаемое время по замерам
+    скоростей; нарезке даётся фора SPLIT_LATENCY_SLACK.
+    """
+    limit = telegram_size_limit(bot)
+    if size <= limit:
+        return 'telegram'
+    can_split = kind in ('video', 'audio') and split_parts_needed(size, limit) <= SPLIT_MAX_PARTS
+    can_cloud = YANDEX_DISK_CLIENT is not None and size <= MAX_YANDEX_SIZE
+    if can_split and can_cloud:
+        split_time = split_throughput.eta(size) + telegram_throughput.eta(size)
+        cloud_time = yandex_throughput.eta(size)
+        return 'split' if split_time <= cloud_time * SPLIT_LATENCY_SLACK else 'cloud'
+    if can_split:
+        return 'split'
+    if can_cloud:
+        return 'cloud'
+    return 'too_large'
+
+async def probe_duration(file_path):
+    """Длительность файла в секундах через ffprobe или None"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', file_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+    except FileNotFoundError:
+        logger.error("❌ ffprobe не найден")
+        return None
+    stdout, _ = await process.communicate()
+    try:
+        return float(stdout.decode().strip())
+    except ValueError:
+        return None
+
+async def split_media(file_path, limit):
+    """
+    Режет видео или аудио без перекодирования (-c copy, сегменты по ключевым
+    кадрам) на части меньше limit рядом с исходным файлом. Длина части
+    считается по среднему битрейту; если какая-то часть всё же вышла больше,
+    режем заново короче. Возвращает пути частей по порядку или None.
+    """
+    size = os.path.getsize(file_path)
+    duration = await probe_duration(file_path)
+    if not duration or not temp_space.fits(size):
+        return None
+    base, ext = os.path.splitext(file_path)
+    pattern = f"{base}.part%03d{ext}"
+    segment_time = duration * limit * SPLIT_PART_FILL / size
+    args = ['-map', '0:v:0?', '-map', '0:a:0?', '-c', 'copy', '-f', 'segment', '-reset_timestamps', '1']
+    if ext in ('.mp4', '.m4a'):
+        # moov в начале каждой части: Telegram сможет играть их потоково
+        args += ['-segment_format_options', 'movflags=+faststart']
+    
+    def parts():
+        folder, prefix = os.path.split(f"{base}.part")
+        return sorted(
+            os.path.join(folder, f) for f in os.listdir(folder)
+            if f.startswith(prefix) and f.endswith(ext)
+        )
+    
+    def cleanup():
+        for part in parts():
+            os.remove(part)
+    
+    started = time.monotonic()
+    for _ in range(SPLIT_ATTEMPTS):
+        cleanup()
+        if not await run_ffmpeg(file_path, pattern, *args, '-segment_time', f"{segment_time:.3f}"):
+            break
+        result = parts()
+        if not result:
+            break
+        biggest = max(os.path.getsize(part) for part in result)
+        if biggest <= limit and len(result) <= SPLIT_MAX_PARTS:
+            split_throughput.observe(size, time.monotonic() - started)
+            logger.info(f"✂️ {os.path.basename(file_path)} нарезан на {len(result)} частей")
+            return result
+        segment_time *= limit * SPLIT_PART_FILL / biggest
+    cleanup()
+    FAILURES.labels('split').inc()
+    return None
+
+async def prepare_parts(job, file_path, limit):
+    """Нарезает файл один раз на всё скачивание; части лежат в папке задачи"""
+    async with job.file_lock(file_path):
+        if file_path not in job.parts:
+            parts = await split_media(file_path, limit)
+            job.parts[file_path] = parts
+            if parts:
+                temp_space.settle(job.temp_dir)
+        return job.parts[file_path]
+
+# ===================== ПРОВЕРКА ПЕРЕД СКАЧИВАНИЕМ =====================
+# Создаем глобальный экземпляр
+info_cache = TTLCache(INFO_CACHE_SIZE, INFO_CACHE_TTL)
+
+def probe_format(url, mode):
+    """Формат, с которым проверяется ссылка: тот же, что скачает режим"""
+    return AUDIO_FORMAT if mode == 'audio' else platform_video_format(classify_url(url))
+
+def info_cache_key(url, mode):
+    """Режимы с одной строкой формата (video и all) делят одну запись"""
+    return f"{normalize_url(url)}|{probe_format(url, mode)}"
+
+# Поля info, которые не нужны ни plan_format, ни скачиванию по готовому info,
+# но занимают больше всего памяти (субтитры YouTube - сотни КБ на ролик)
+INFO_CACHE_DROP = ('subtitles', 'automatic_captions', 'requested_subtitles', 'thumbnails', 'heatmap',
+                   'chapters', 'description', 'comments', 'tags', 'categories')
+
+def slim_info(info):
+    """Копия info для info_cache без тяжёлых полей и форматов-раскадровок"""
+    # Без thumbnails yt-dlp сам соберёт их из info['thumbnail']
+    info = {key: value for key, value in info.items() if key not in INFO_CACHE_DROP}
+    if info.get('formats'):
+        info['formats'] = [fmt for fmt in info['formats'] if fmt.get('format_note') != 'storyboard']
+    return info
+
+async def fetch_info(url, mode):
+    """
+    Метаданные ролика без скачивания (extract_info(download=False)) с уже
+    выбранным форматом режима; из info_cache, если их недавно получали.
+    None, если ссылку разобрать не удалось или это не одно видео.
+    """
+    key = info_cache_key(url, mode)
+    info = info_cache.get(key)
+    CACHE_LOOKUPS.labels('info', 'hit' if info else 'miss').inc()
+    if info is not None:
+        return info
+    try:
+        opts = ytdlp_options(classify_url(url), format=probe_format(url, mode))
+        started = time.monotonic()
+        info = await ytdlp_processes.run('probe', url, opts)
+        STAGE_SECONDS.labels('preflight', detect_platform(url), mode).observe(time.monotonic() - started)
+    except YtdlpError as e:
+        logger.warning(f"⚠️ Проверка перед скачиванием не удалась, качаю без неё: {e}")
+        return None
+    if not info or info.get('_type', 'video') != 'video':
+        return None
+    info = slim_info(info)
+    info_cache.set(key, info)
+    return info
+
+def format_bytes_estimate(fmt, duration):
+    """Размер формата: filesize, filesize_approx или битрейт (tbr, кбит/с) × длительность"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return int(size) if size else None
+
+def estimate_size(info, mode):
+    """Ожидаемый размер самого большого файла результата по info или None"""
+    duration = info.get('duration')
+    if mode == 'audio' and AUDIO_CODEC == 'mp3':
+        # MP3 всегда перекодируется: размер задаёт битрейт, а не исходный формат
+        return int(duration * int(AUDIO_QUALITY) * 1000 / 8) if duration else None
+    sizes = [format_bytes_estimate(fmt, duration) for fmt in info.get('requested_formats') or [info]]
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+def plan_format(info, mode, budget):
+    """
+    Самый качественный формат из info['formats'] (или пара видео+аудио для
+    склейки в mp4), который по оценке укладывается в budget байт.
+    Возвращает (строка формата yt-dlp, оценка размера) или (None, None).
+    """
+    duration = info.get('duration')
+    formats = info.get('formats') or []
+    
+    def size(*fmts):
+        sizes = [format_bytes_estimate(fmt, duration) for fmt in fmts]
+        return None if None in sizes else sum(sizes)
+    
+    options = []  # (качество, размер, формат)
+    if mode == 'audio':
+        for fmt in formats:
+            if fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none':
+                # AAC в приоритете: его не нужно перекодировать (AUDIO_POLICY=copy)
+                quality = ((fmt.get('acodec') or '').startswith('mp4a'), fmt.get('abr') or fmt.get('tbr') or 0)
+                options.append((quality, size(fmt), fmt['format_id']))
+    else:
+        audios = [
+            fmt for fmt in formats
+            if fmt.get('vcodec') == 'none' and (fmt.get('acodec') or '').startswith('mp4a')
+        ]
+        for fmt in formats:
+            if fmt.get('vcodec') == 'none' or (fmt.get('height') or 0) < FORMAT_MIN_HEIGHT:
+                continue
+            quality = (fmt.get('height') or 0, fmt.get('tbr') or 0)
+            if fmt.get('acodec') != 'none':
+                if fmt.get('ext') == 'mp4':
+                    options.append((quality, size(fmt), fmt['format_id']))
+            elif fmt.get('ext') == 'mp4' and (fmt.get('vcodec') or '').startswith('avc1'):
+                # H.264 + AAC склеиваются в mp4 без перекодирования
+                for audio in audios:
+                    options.append((quality, size(fmt, audio), f"{fmt['format_id']}+{audio['format_id']}"))
+    
+    fitting = [option for option in options if option[1] and option[1] <= budget]
+    if not fitting:
+        return None, None
+    _, est, format_id = max(fitting, key=lambda option: (option[0], option[1]))
+    return format_id, est
+
+def plan_download(bot, info, mode, size):
+    """
+    Формат по умолчанию (оценка size) больше бюджета: подбирает формат поменьше,
+    а если ни один не влез - при REENCODE_FALLBACK перекодирование видео в битрейт
+    под бюджет. Возвращает (план для download_video или None, новая оценка).
+    """
+    budget = (SIZE_BUDGET or telegram_size_limit(bot)) * SIZE_BUDGET_MARGIN
+    if size <= budget or (mode == 'audio' and AUDIO_CODEC == 'mp3'):
+        return None, size
+    format_id, est = plan_format(info, mode, budget)
+    if format_id:
+        FORMAT_PLANS.labels('downsized').inc()
+        logger.info(f"📐 Формат {format_id} (~{est / 1024 / 1024:.1f} МБ) вместо ~{size / 1024 / 1024:.1f} МБ")
+        return {'format': format_id}, est
+    duration = info.get('duration')
+    if REENCODE_FALLBACK and mode != 'audio' and duration:
+        video_kbps = int(budget * 8 / 1000 / duration) - REENCODE_AUDIO_KBPS
+        if video_kbps >= REENCODE_MIN_VIDEO_KBPS:
+            FORMAT_PLANS.labels('reencode').inc()
+            logger.info(f"📐 Ни один формат не влез, перекодирую видео в {video_kbps} кбит/с")
+            return {'video_kbps': video_kbps, 'budget': budget}, int(budget)
+    FORMAT_PLANS.labels('no_fit').inc()
+    return None, size
+
+async def preflight(job, bot, url, mode):
+    """
+    Проверяет ссылку до скачивания: подбирает формат под лимит (plan_download),
+    по оценке размера выбирает путь доставки (choose_delivery) и, если файл
+    никак не доставить, помечает job.rejected - тогда качать не нужно.
+    Возвращает (info, оценка размера, план) для скачивания.
+    """
+    if not PREFLIGHT:
+        return None, None, None
+    info = await fetch_info(url, mode)
+    size = estimate_size(info, mode) if info else None
+    if size is None:
+        return info, None, None
+    plan, size = plan_download(bot, info, mode, size)
+    route = choose_delivery(bot, size, 'audio' if mode == 'audio' else 'video')
+    logger.info(f"🧭 {url}: ~{size / 1024 / 1024:.1f} МБ, доставка: {route}")
+    if route == 'too_large':
+        job.rejected = size
+        FAILURES.labels('too_large').inc()
+        DELIVERY_PATHS.labels('too_large').inc()
+    return info, size, plan
+
+# ===================== НЕСКОЛЬКО ССЫЛОК И ПЛЕЙЛИСТЫ =====================
+URL_RE = re.compile(r'(?:https?://|www\.)[^\s<>"\']+', re.IGNORECASE)
+
+def extract_urls(message):
+    """
+    Ссылки из сообщения в порядке появления: из разметки Telegram, иначе
+    регулярным выражением, иначе слова сообщения, похожие на ссылку на ролик.
+    """
+    urls = []
+    entities = message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK])
+    for entity, text in entities.items():
+        urls.append(entity.url if entity.type == MessageEntity.TEXT_LINK else text)
+    if not urls:
+        urls = URL_RE.findall(message.text or '')
+    if not urls:
+        # Ссылка без схемы и www, которую Telegram не разметил: берём только само слово
+        urls = [word for word in (message.text or '').split() if classify_url(word.rstrip('.,;:!?)'))]
+    urls = [url.rstrip('.,;:!?)') for url in urls]
+    urls = [url if '://' in url else f"https://{url}" for url in urls]
+    return list(dict.fromkeys(urls))[:MAX_LINKS_PER_MESSAGE]
+
+def is_playlist_url(url):
+    """Ссылка на плейлист целиком, а не на ролик из него (watch?v=...&list=... - это ролик)"""
+    parsed = urlparse(url)
+    query = dict(parse_qsl(parsed.query))
+    if 'list' in query and 'v' not in query:
+        return True
+    return '/playlist' in parsed.path or '/sets/' in parsed.path
+
+async def expand_playlist(url):
+    """Ссылки на ролики плейлиста (не больше PLAYLIST_LIMIT) без скачивания самих роликов"""
+    try:
+        opts = ytdlp_options(classify_url(url))
+        opts.update({'extract_flat': 'in_playlist', 'noplaylist': False, 'playlistend': PLAYLIST_LIMIT})
+        info = await ytdlp_processes.run('probe', url, opts)
+    except YtdlpError as e:
+        logger.error(f"❌ Не удалось разобрать плейлист {url}: {e}")
+        return [url]
+    if info.get('_type') != 'playlist':
+        return [url]
+    entries = [entry.get('url') or entry.get('webpage_url') for entry in info.get('entries') or []]
+    entries = [entry for entry in entries if entry][:PLAYLIST_LIMIT]
+    logger.info(f"📃 Плейлист {url}: {len(entries)} роликов")
+    return entries or [url]
+
+async def expand_urls(urls):
+    """Разворачивает плейлисты, остальные ссылки оставляет как есть"""
+    expanded = await asyncio.gather(*(
+        expand_playlist(url) if is_playlist_url(url) else asyncio.sleep(0, [url]) for url in urls
+    ))
+    return list(dict.fromkeys(url for group in expanded for url in group))
+
+# ===================== ОДНО СКАЧИВАНИЕ НА ОДИНАКОВЫЕ ССЫЛКИ =====================
+class DownloadJob:
+    """Скачивание, результат которого делят все, кто прислал ту же ссылку"""
+    
+    def __init__(self, key):
+        self.key = key
+        self.done = asyncio.get_running_loop().create_future()
+        self.refs = 0
+        self.files = None
+        self.temp_dir = None
+        self.sent = {}   # путь файла -> {'kind', 'file_id'} после первой отправки
+        self.cloud = {}  # путь файла -> (public_url, delete_time) после загрузки в облако
+        self.parts = {}  # путь файла -> пути частей после нарезки (None - не вышло)
+        self.rejected = None  # оценка размера, если файл не доставить и скачивание отменено
+        self.progress = None  # JobProgress первого запросившего, к нему подписываются остальные
+        self.platform = 'other'
+        self.mode = None
+        self._locks = {}
+    
+    def file_lock(self, file_path):
+        """Замок на файл: первый отправляет, остальные берут его file_id"""
+        return self._locks.setdefault(file_path, asyncio.Lock())
+
+class SingleFlight:
+    """Склеивает одновременные скачивания одной ссылки в одно"""
+    
+    def __init__(self):
+        self._jobs = {}
+        self.joined = 0
+    
+    def in_progress(self, key):
+        return key in self._jobs
+    
+    def get(self, key):
+        return self._jobs.get(key)
+    
+    async def acquire(self, key, download):
+        """
+        Возвращает общий DownloadJob. Первый запросивший выполняет download(job)
+        сам, остальные ждут его результата. Каждый acquire требует release.
+        """
+        job = self._jobs.get(key)
+        if job is not None:
+            job.refs += 1
+            self.joined += 1
+            logger.info(f"🔗 Присоединяюсь к уже идущему скачиванию ({job.refs} ждут)")
+            try:
+                job.files, job.temp_dir = await asyncio.shield(job.done)
+            except BaseException:
+                self.release(job)
+                raise
+            return job
+        
+        job = DownloadJob(key)
+        job.refs = 1
+        self._jobs[key] = job
+        try:
+            result = await download(job)
+        except BaseException:
+            # Ожидающим достаётся обычный неуспех, исключение получит только первый
+            self._forget(job)
+            job.done.set_result((None, None))
+            self.release(job)
+            raise
+        job.files, job.temp_dir = result
+        if not job.files:
+            # Неуспех не делим с новыми запросами: они скачают заново. Уже
+            # присоединившиеся держат job сами и получат результат из done
+            self._forget(job)
+        job.done.set_result(result)
+        return job
+    
+    def _forget(self, job):
+        """Убирает job из _jobs, чтобы к нему больше не присоединялись"""
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+    
+    def release(self, job):
+        """Отпускает результат; последний удаляет временную папку"""
+        job.refs -= 1
+        if job.refs > 0:
+            return
+        self._forget(job)
+        temp_space.remove(job.temp_dir)
+
+# Создаем глобальный экземпляр
+single_flight = SingleFlight()
+
+# ===================== ОЧЕРЕДЬ ЗАДАНИЙ ДЛЯ ВОРКЕРОВ =====================
+class JobQueue:
+    """
+    Очередь заданий в SQLite (режим WAL) для BOT_ROLE=front/worker на одном хосте:
+    WAL работает только для процессов, которые делят разделяемую память (-shm).
+    Front кладёт задание - апдейт, сообщение о статусе, ссылки и режим;
+    воркер забирает его в аренду на JOB_LEASE секунд и продлевает её, пока
+    работает. Задание пропавшего воркера front возвращает в очередь, а после
+    JOB_MAX_ATTEMPTS выдач отмечает потерянным. Завершённые задания с отчётом
+    воркера front забирает и удаляет. Методы синхронные: из event loop их
+    зовут через asyncio.to_thread.
+    """
+    
+    def __init__(self, db_path):
+        # Соединение общее для потоков to_thread, поэтому под замком
+        self._lock = Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id     TEXT NOT NULL,
+                payload     TEXT NOT NULL,
+                state       TEXT NOT NULL DEFAULT 'queued',
+                worker      TEXT,
+                lease_until REAL,
+                attempts    INTEGER NOT NULL DEFAULT 0,
+                report      TEXT,
+                created     REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, id)")
+    
+    def put(self, user_id, payload):
+        """Кладёт задание в очередь, возвращает его id"""
+        with self._lock:
+            return self.db.execute(
+                "INSERT INTO jobs (user_id, payload, created) VALUES (?, ?, ?)",
+                (str(user_id), json.dumps(payload), time.time())
+            ).lastrowid
+    
+    def admission(self, user_id):
+        """Как admit_error пула, но по всем воркерам: (причина отказа или None, заданий пользователя)"""
+        with self._lock:
+            user_jobs, queued = self.db.execute(
+                "SELECT COALESCE(SUM(user_id = ?), 0), COALESCE(SUM(state = 'queued'), 0) "
+                "FROM jobs WHERE state IN ('queued', 'running')",
+                (str(user_id),)
+            ).fetchone()
+        if user_jobs >= MAX_JOBS_PER_USER:
+            return 'user', user_jobs
+        if queued >= MAX_QUEUE:
+            return 'busy', user_jobs
+        return None, user_jobs
+    
+    def claim(self, worker):
+        """Берёт в аренду самое старое задание: (id, payload) или None"""
+        with self._lock:
+            # IMMEDIATE сразу занимает запись: два воркера не возьмут одно задание
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT id, payload FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row:
+                    self.db.execute(
+                        "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (worker, time.time() + JOB_LEASE, row[0])
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return (row[0], json.loads(row[1])) if row else None
+    
+    def heartbeat(self, worker):
+        """Продлевает аренду всех заданий воркера"""
+        with self._lock:
+            self.db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = 'running'",
+                (time.time() + JOB_LEASE, worker)
+            )
+    
+    def finish(self, job_id, worker, report, ok=True):
+        """Отмечает задание выполненным с отчётом для front (если аренду не отдали другому воркеру)"""
+        with self._lock:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, report = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                ('done' if ok else 'failed', json.dumps(report), job_id, worker)
+            )
+    
+    def release(self, job_ids, worker):
+        """Возвращает в очередь задания остановленного воркера, попытка не засчитывается"""
+        with self._lock:
+            self.db.executemany(
+                "UPDATE jobs SET state = 'queued', worker = NULL, attempts = attempts - 1 "
+                "WHERE id = ? AND worker = ? AND state = 'running'",
+                [(job_id, worker) for job_id in job_ids]
+            )
+    
+    def collect(self):
+        """
+        Для front: возвращает в очередь задания с истёкшей арендой (или отмечает
+        их потерянными) и забирает завершённые - список (payload, state, report)
+        """
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute(
+                    "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'lost' ELSE 'queued' END, worker = NULL "
+                    "WHERE state = 'running' AND lease_until < ?",
+                    (JOB_MAX_ATTEMPTS, time.time())
+                )
+                rows = self.db.execute(
+                    "SELECT id, payload, state, report FROM jobs WHERE state IN ('done', 'failed', 'lost')"
+                ).fetchall()
+                self.db.executemany("DELETE FROM jobs WHERE id = ?", [(row[0],) for row in rows])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return [(json.loads(payload), state, json.loads(report) if report else []) for _, payload, state, report in rows]
+    
+    def depth(self):
+        """Сколько заданий ждут воркера"""
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+# Глобальный экземпляр открывается в on_startup (очередь нужна только при раздельных ролях)
+job_queue = None
+
+# Отчёт задания, которое сейчас выполняет воркер: пока он задан, доставки не
+# пишутся в статистику и кэш этого процесса, а уходят front (см. run_queued_job)
+job_report = ContextVar('job_report', default=None)
+
+def record_delivery(user_id, via_cloud=False, cache_key=None, items=None):
+    """Статистика пользователя и кэш результатов после доставки (cache_key - если результат можно кэшировать)"""
+    report = job_report.get()
+    if report is not None:
+        report.append({'user_id': user_id, 'via_cloud': via_cloud, 'cache_key': cache_key,
+                       'items': items if cache_key else None})
+        return
+    user_data.add_download(user_id, via_cloud=via_cloud)
+    if cache_key and items:
+        result_cache.set(cache_key, items)
 
 # ===================== ФУНКЦИЯ СОЗДАНИЯ QR-КОДА =====================
-def make_qr(text):
-    """Создает QR-код из текста"""
+def render_qr(text, box_size=QR_BOX_SIZE, border=QR_BORDER):
+    """Рисует QR-код и возвращает PNG в байтах, без временных файлов"""
+    import qrcode
+    
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(text)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+class QRRenderer:
+    """Рендерит QR-коды в отдельном пуле потоков и кэширует результат"""
+    
+    def __init__(self, workers, cache_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="harti-qr")
+        # Значение - file_id после первой отправки, до неё - PNG в байтах
+        self.cache = TTLCache(cache_size)
+    
+    @staticmethod
+    def make_key(text):
+        return (text, QR_BOX_SIZE, QR_BORDER)
+    
+    async def make_qr(self, text):
+        """Возвращает (ключ, file_id или PNG) для отправки через reply_photo"""
+        key = self.make_key(text)
+        photo = self.cache.get(key)
+        CACHE_LOOKUPS.labels('qr', 'miss' if photo is None else 'hit').inc()
+        if photo is None:
+            photo = await asyncio.get_running_loop().run_in_executor(self.executor, render_qr, text)
+            self.cache.set(key, photo)
+        return key, photo
+    
+    def remember(self, key, message):
+        """Запоминает file_id отправленного QR, чтобы не слать PNG повторно"""
+        if message and message.photo:
+            self.cache.set(key, message.photo[-1].file_id)
+
+# Создаем глобальный экземпляр
+qr_renderer = QRRenderer(QR_WORKERS, QR_CACHE_SIZE)
+
+async def send_qr(message, text):
+    """Создаёт QR-код и отправляет его ответом на сообщение"""
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        path = os.path.join(TEMP_DIR, f"qr_{timestamp}.png")
-        
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
+        key, photo = await qr_renderer.make_qr(text)
+        sent = await message.reply_photo(
+            photo=photo,
+            caption=f"✅ *QR-код готов!*",
+            reply_markup=get_back_button(),
+            parse_mode='Markdown'
         )
-        qr.add_data(text)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        img.save(path)
-        
-        return path
+        qr_renderer.remember(key, sent)
+        return True
     except Exception as e:
         logger.error(f"Ошибка создания QR: {e}")
-        return None
+        return False
 
 # ===================== ФУНКЦИИ ДЛЯ МЕНЮ =====================
 def get_main_menu(user_id):
@@ -499,9 +2405,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
     first_name = update.effective_user.first_name
+    limit_mb = telegram_size_limit(context.bot) // (1024 * 1024)
     
-    yandex_status = "✅ Яндекс.Диск подключен (автоудаление через 12ч)" if YANDEX_DISK_CLIENT else "⚠️ Яндекс.Диск не настроен (будут только файлы до 50 МБ)"
-    cookies_status = "🍪 Cookies найдены" if os.path.exists('cookies.txt') else "⚠️ Cookies не найдены (YouTube может не работать)"
+    yandex_status = "✅ Яндекс.Диск подключен (автоудаление через 12ч)" if YANDEX_DISK_CLIENT else f"⚠️ Яндекс.Диск не настроен (будут только файлы до {limit_mb} МБ)"
+    cookies_status = "🍪 Cookies найдены" if 'cookiefile' in YTDLP_OPTIONS else "⚠️ Cookies не найдены (YouTube может не работать)"
     
     welcome_text = (
         f"⚡ *HartiDash — твой быстрый загрузчик!*\n\n"
@@ -509,8 +2416,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📌 *Как пользоваться:*\n"
         f"• Отправь ссылку на видео\n"
         f"• Я скачаю в выбранном формате\n"
-        f"• Файлы до 50 МБ → отправляю сразу\n"
-        f"• Файлы больше 50 МБ → загружаю на Яндекс.Диск\n"
+        f"• Файлы до {limit_mb} МБ → отправляю сразу\n"
+        f"• Файлы больше {limit_mb} МБ → загружаю на Яндекс.Диск\n"
         f"• Файлы в облаке **автоматически удаляются через 12 часов**\n\n"
         f"📊 *Статус:*\n"
         f"{yandex_status}\n"
@@ -530,14 +2437,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📖 *HartiDash — Помощь*\n\n"
         "*🎥 Форматы:*\n"
         "• Видео — скачать только видео (MP4)\n"
-        "• Аудио — скачать только аудио (MP3)\n"
+        f"• Аудио — скачать только аудио ({AUDIO_CODEC.upper()})\n"
         "• Всё — скачать видео + аудио + обложку\n\n"
         "*📱 QR-коды:*\n"
         "• /qr текст — создать QR-код\n\n"
         "*🌐 Поддерживаемые сайты:*\n"
         "✅ TikTok, YouTube, Instagram, Facebook, Twitter/X\n\n"
         "*📦 Большие файлы:*\n"
-        "• Файлы >50 МБ загружаются на Яндекс.Диск\n"
+        f"• Файлы >{telegram_size_limit(context.bot) // (1024 * 1024)} МБ загружаются на Яндекс.Диск\n"
         "• Файлы **автоматически удаляются через 12 часов**\n"
         "• Вы получаете прямую ссылку на скачивание\n\n"
         "*📊 Статистика:*\n"
@@ -567,17 +2474,7 @@ async def qr_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = ' '.join(context.args)
     status_msg = await update.message.reply_text("🔄 *Создаю QR-код...*", parse_mode='Markdown')
     
-    path = make_qr(text)
-    
-    if path:
-        with open(path, 'rb') as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption=f"✅ *QR-код готов!*",
-                reply_markup=get_back_button(),
-                parse_mode='Markdown'
-            )
-        os.unlink(path)
+    if await send_qr(update.message, text):
         await status_msg.delete()
         user_data.add_qr(user_id)
     else:
@@ -605,135 +2502,626 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+# ===================== СООБЩЕНИЕ О СТАТУСЕ =====================
+def format_eta(seconds):
+    """Человекочитаемое время ожидания"""
+    if seconds < 60:
+        return f"~{max(1, int(seconds))} сек"
+    return f"~{int(seconds // 60) + 1} мин"
+
+class StatusMessage:
+    """
+    Сообщение о ходе задачи. update() можно звать сколько угодно часто:
+    правки склеиваются и уходят не чаще раза в STATUS_EDIT_INTERVAL секунд,
+    не чаще раза в CHAT_EDIT_INTERVAL на весь чат и не больше STATUS_MAX_EDITS
+    раз за задачу - так мы не упираемся в лимиты Telegram на правки.
+    """
+    
+    _chat_next_edit = {}  # chat_id -> когда в чате можно следующую правку
+    
+    def __init__(self, message, text):
+        self.message = message
+        self.text = text
+        self.edits = 0
+        self._pending = None
+        self._task = None
+        self._closed = False
+        self._last_edit = time.monotonic()
+    
+    @classmethod
+    def _reserve_chat_slot(cls, chat_id):
+        """Занимает ближайшее окно для правки в чате, возвращает сколько ждать"""
+        now = time.monotonic()
+        slot = max(now, cls._chat_next_edit.get(chat_id, 0.0))
+        cls._chat_next_edit[chat_id] = slot + CHAT_EDIT_INTERVAL
+        if len(cls._chat_next_edit) > 10000:
+            cls._chat_next_edit = {k: v for k, v in cls._chat_next_edit.items() if v > now}
+        return slot - now
+    
+    @classmethod
+    async def send(cls, reply_to, text):
+        message = await reply_to.reply_text(text, parse_mode='Markdown')
+        return cls(message, text)
+    
+    def update(self, text):
+        """Запоминает новый текст и планирует правку"""
+        if self._closed or self.edits >= STATUS_MAX_EDITS:
+            return
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush())
+    
+    async def _flush(self):
+        while self._pending is not None:
+            delay = self._last_edit + STATUS_EDIT_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._pending is None or self._pending == self.text:
+                self._pending = None
+                continue
+            await asyncio.sleep(self._reserve_chat_slot(self.message.chat_id))
+            # За время ожидания текст мог обновиться - берём самый свежий
+            text, self._pending = self._pending, None
+            if text is None or text == self.text:
+                continue
+            try:
+                self.edits += 1
+                await self.message.edit_text(text, parse_mode='Markdown')
+                self.text = text
+            except Exception as e:
+                logger.debug(f"Статус не обновился: {e}")
+            self._last_edit = time.monotonic()
+    
+    async def _cancel(self):
+        self._closed = True
+        self._pending = None
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+    
+    async def edit_text(self, text, **kwargs):
+        """Правит сообщение сразу, отменяя отложенные правки"""
+        await self._cancel()
+        await self.message.edit_text(text, **kwargs)
+        self.text = text
+    
+    async def delete(self):
+        await self._cancel()
+        await self.message.delete()
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+class JobProgress:
+    """
+    Превращает хуки yt-dlp в обновления сообщений о статусе задачи.
+    Хуки вызывает YtdlpProcessPool в event loop, по сообщениям процесса-воркера.
+    """
+    
+    HOOK_INTERVAL = 0.5  # секунд между обновлениями статуса по прогрессу скачивания
+    
+    def __init__(self, status):
+        self.statuses = [status]
+        self._last_progress = 0.0
+    
+    def watch(self, status):
+        """Подписывает ещё одно сообщение (того, кто ждёт ту же ссылку)"""
+        self.statuses.append(status)
+    
+    def phase(self, text):
+        """Показывает текст во всех подписанных сообщениях"""
+        for status in self.statuses:
+            status.update(text)
+    
+    def download_hook(self, d):
+        """progress_hooks yt-dlp"""
+        if d['status'] == 'finished':
+            self.phase("⚙️ *Скачано, обрабатываю...*")
+            return
+        if d['status'] != 'downloading':
+            return
+        now = time.monotonic()
+        if now - self._last_progress < self.HOOK_INTERVAL:
+            return
+        self._last_progress = now
+        
+        downloaded = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        lines = ["📥 *Скачиваю...*"]
+        if total:
+            lines.append(f"{downloaded / total * 100:.0f}% · {format_size(downloaded)} из {format_size(total)}")
+        else:
+            lines.append(format_size(downloaded))
+        details = []
+        if d.get('speed'):
+            details.append(f"{format_size(d['speed'])}/с")
+        if d.get('eta') is not None:
+            details.append(f"осталось {format_eta(d['eta'])}")
+        if details:
+            lines.append(" · ".join(details))
+        self.phase("\n".join(lines))
+    
+    def postprocessor_hook(self, d):
+        """postprocessor_hooks yt-dlp: показывает этап ffmpeg"""
+        if d['status'] == 'started':
+            self.phase(f"⚙️ *Обработка ffmpeg:* {d.get('postprocessor', '')}")
+
 # ===================== ОБРАБОТЧИК СООБЩЕНИЙ =====================
+async def send_file(message, job, file_path):
+    """Отправляет файл; если его уже отправили из этого же скачивания - по file_id"""
+    kind = media_kind(file_path)
+    if kind is None:
+        return None
+    async with job.file_lock(file_path):
+        item = job.sent.get(file_path)
+        if item:
+            await reply_media(message, item['kind'], item['file_id'])
+            return item
+        started = time.monotonic()
+        with ExitStack() as files:
+            msg = await reply_media(message, kind, media_source(message.get_bot(), file_path, files))
+        STAGE_SECONDS.labels('telegram_send', job.platform, job.mode).observe(time.monotonic() - started)
+        UPLOADED_BYTES.labels('telegram').inc(os.path.getsize(file_path))
+        telegram_throughput.observe(os.path.getsize(file_path), time.monotonic() - started)
+        item = sent_media(msg)
+        if item:
+            job.sent[file_path] = item
+        return item or {}
+
+async def upload_file(job, file_path, user_id, chat_id):
+    """Загружает файл в облако один раз на всё скачивание"""
+    async with job.file_lock(file_path):
+        if file_path not in job.cloud:
+            started = time.monotonic()
+            public_url, delete_time = await upload_to_yandex(file_path, user_id=user_id, chat_id=chat_id)
+            if not public_url:
+                return None, None
+            STAGE_SECONDS.labels('yandex_upload', job.platform, job.mode).observe(time.monotonic() - started)
+            job.cloud[file_path] = (public_url, delete_time)
+        return job.cloud[file_path]
+
+def too_large_reason():
+    """Почему большой файл не ушёл и в облако"""
+    if not YANDEX_DISK_CLIENT:
+        return "Яндекс.Диск не настроен. Добавьте токен для загрузки больших файлов."
+    return f"В облако загружаются файлы до {MAX_YANDEX_SIZE / (1024 * 1024):.0f} МБ."
+
+def too_large_text(size):
+    """Ответ про файл, который не доставить ни через Telegram, ни через облако"""
+    return f"⚠️ *Файл слишком большой для Telegram ({size / (1024 * 1024):.1f} МБ)*\n\n{too_large_reason()}"
+
+async def send_cloud_link(message, job, file_path, user_id, chat_id):
+    """Загружает большой файл на Яндекс.Диск и отвечает ссылкой; True, если получилось"""
+    size = os.path.getsize(file_path)
+    size_mb = size / (1024 * 1024)
+    if not YANDEX_DISK_CLIENT or size > MAX_YANDEX_SIZE:
+        FAILURES.labels('too_large').inc()
+        DELIVERY_PATHS.labels('too_large').inc()
+        await message.reply_text(too_large_text(size), parse_mode='Markdown')
+        return False
+    
+    logger.info(f"📤 Файл большой ({size_mb:.1f} МБ), загружаю на Яндекс.Диск")
+    public_url, delete_time = await upload_file(job, file_path, user_id, chat_id)
+    if not public_url:
+        await message.reply_text(
+            f"❌ *Не удалось загрузить файл на Яндекс.Диск*\n"
+            f"Размер: {size_mb:.1f} МБ",
+            parse_mode='Markdown'
+        )
+        return False
+    
+    DELIVERY_PATHS.labels('cloud').inc()
+    file_type = {'video': "Видео", 'audio': "Аудио"}.get(media_kind(file_path), "Файл")
+    await message.reply_text(
+        f"📦 *{file_type} большой ({size_mb:.1f} МБ)*\n\n"
+        f"Telegram не может отправить файлы больше "
+        f"{telegram_size_limit(message.get_bot()) / (1024 * 1024):.0f} МБ.\n"
+        f"🔗 [Скачать с Яндекс.Диска]({public_url})\n\n"
+        f"⏰ *Файл будет автоматически удален через 12 часов* (до {delete_time})",
+        parse_mode='Markdown',
+        disable_web_page_preview=True
+    )
+    logger.info(f"✅ Ссылка на Яндекс.Диск отправлена, удаление в {delete_time}")
+    return True
+
+async def send_parts(message, job, file_path):
+    """Нарезает большой файл и отправляет части альбомом; {'kind', 'file_id'} частей или None"""
+    parts = await prepare_parts(job, file_path, telegram_size_limit(message.get_bot()))
+    if not parts:
+        return None
+    kind = media_kind(file_path)
+    async with job.file_lock(file_path):
+        # Части уже отправлял кто-то с той же ссылкой - повторяем по file_id
+        entries = [(kind, job.sent[part]['file_id'] if part in job.sent else part) for part in parts]
+        started = time.monotonic()
+        items = await send_media_groups(message, entries)
+        STAGE_SECONDS.labels('telegram_send', job.platform, job.mode).observe(time.monotonic() - started)
+        for part, item in zip(parts, items):
+            if item:
+                job.sent[part] = item
+    logger.info(f"✅ {kind} отправлено через Telegram в {len(parts)} частях")
+    return items
+
+async def deliver_job(update, job, status_msg, user_id, chat_id, cache_key):
+    """Отправляет пользователю результат скачивания"""
+    files = job.files
+    if job.rejected:
+        await status_msg.edit_text(too_large_text(job.rejected), reply_markup=get_back_button(), parse_mode='Markdown')
+        return
+    if not files:
+        await status_msg.edit_text(
+            "❌ *Не удалось скачать файлы*\n"
+            "Возможно, ссылка недействительна или видео защищено",
+            reply_markup=get_back_button(),
+            parse_mode='Markdown'
+        )
+        return
+    
+    sent_count = 0
+    cloud_used = False
+    sent_items = []
+    
+    for file_path in files:
+        try:
+            if not os.path.exists(file_path):
+                logger.error(f"Файл не существует: {file_path}")
+                continue
+            
+            file_size = os.path.getsize(file_path)
+            logger.info(f"Файл: {file_path}, размер: {file_size} байт")
+            
+            path = choose_delivery(update.get_bot(), file_size, media_kind(file_path))
+            if path == 'split':
+                # Больше лимита - режем на части и отправляем альбомом
+                items = await send_parts(update.message, job, file_path)
+                if items is not None:
+                    DELIVERY_PATHS.labels('split').inc()
+                    sent_items.extend(items)
+                    sent_count += 1
+                    continue
+                logger.warning(f"⚠️ Не удалось нарезать {file_path}, пробую облако")
+                path = 'cloud'
+            
+            if path == 'telegram':
+                # Маленький файл - отправляем через Telegram
+                item = await send_file(update.message, job, file_path)
+                if item is not None:
+                    DELIVERY_PATHS.labels('telegram').inc()
+                    sent_items.append(item)
+                    logger.info(f"✅ {media_kind(file_path)} отправлено через Telegram")
+                    sent_count += 1
+            else:
+                # Большой файл - загружаем на Яндекс.Диск
+                if await send_cloud_link(update.message, job, file_path, user_id, chat_id):
+                    sent_count += 1
+                    cloud_used = True
+            
+        except Exception as e:
+            FAILURES.labels('telegram_send').inc()
+            logger.error(f"❌ Ошибка отправки файла {file_path}: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            await update.message.reply_text(f"❌ Ошибка при отправке: {str(e)[:100]}")
+    
+    await status_msg.delete()
+    
+    # Одна запись статистики на скачивание, в том числе через облако;
+    # кэшируем только полностью отправленный через Telegram результат
+    cacheable = not cloud_used and sent_items and sent_count == len(files) and all(sent_items)
+    record_delivery(user_id, cloud_used, cache_key if cacheable else None, sent_items)
+    
+    if sent_count == 0:
+        await update.message.reply_text(
+            "❌ *Не удалось отправить файлы*\n"
+            "Проверьте логи для подробностей",
+            reply_markup=get_back_button(),
+            parse_mode='Markdown'
+        )
+
+async def reject_if_overloaded(status_msg, user_id):
+    """Отказывает в приёме задачи, если пул не может её взять; True - задача отклонена"""
+    admit_error = download_pool.admit_error(user_id)
+    if not admit_error:
+        return False
+    await reject_admission(status_msg, admit_error, download_pool.user_jobs(user_id))
+    return True
+
+async def reject_admission(status_msg, admit_error, user_jobs):
+    """Объясняет пользователю, почему задача не принята (причина из admit_error пула или очереди)"""
+    FAILURES.labels(f"rejected_{admit_error}").inc()
+    logger.info(f"🚦 Задача не принята: {admit_error}")
+    if admit_error == 'user':
+        await status_msg.edit_text(
+            f"⏳ *У тебя уже {user_jobs} загрузки в работе*\n"
+            f"Дождись их окончания и отправь ссылку снова",
+            parse_mode='Markdown'
+        )
+    elif admit_error == 'busy':
+        await status_msg.edit_text(
+            "🚦 *Бот сейчас перегружен*\n"
+            "Попробуй отправить ссылку через пару минут",
+            parse_mode='Markdown'
+        )
+    elif admit_error == 'disk':
+        await status_msg.edit_text(
+            "💾 *На сервере закончилось место*\n"
+            "Попробуй отправить ссылку позже",
+            parse_mode='Markdown'
+        )
+
+def input_media(kind, media):
+    if kind == 'video':
+        return InputMediaVideo(media, supports_streaming=True)
+    if kind == 'photo':
+        return InputMediaPhoto(media)
+    if kind == 'audio':
+        return InputMediaAudio(media)
+    return InputMediaDocument(media)
+
+async def send_media_groups(message, entries):
+    """
+    Отправляет файлы альбомами по MEDIA_GROUP_SIZE: видео с фото, аудио и документы
+    отдельно друг от друга (Telegram не смешивает их в одном альбоме). entries - список
+    (kind, file_id или путь к файлу); возвращает {'kind', 'file_id'} для каждого в том же порядке.
+    """
+    results = [None] * len(entries)
+    groups = {'visual': [], 'audio': [], 'document': []}
+    for index, (kind, _) in enumerate(entries):
+        groups['visual' if kind in ('video', 'photo') else 'audio' if kind == 'audio' else 'document'].append(index)
+    
+    for indexes in groups.values():
+        for start in range(0, len(indexes), MEDIA_GROUP_SIZE):
+            chunk = indexes[start:start + MEDIA_GROUP_SIZE]
+            with ExitStack() as files:
+                media = []
+                uploaded = 0
+                for index in chunk:
+                    kind, source = entries[index]
+                    if os.path.exists(source):
+                        uploaded += os.path.getsize(source)
+                        source = media_source(message.get_bot(), source, files)
+                    media.append((kind, source))
+                started = time.monotonic()
+                if len(media) == 1:
+                    messages = [await reply_media(message, *media[0])]
+                else:
+                    messages = await message.reply_media_group([input_media(kind, source) for kind, source in media])
+                UPLOADED_BYTES.labels('telegram').inc(uploaded)
+                telegram_throughput.observe(uploaded, time.monotonic() - started)
+            for index, msg in zip(chunk, messages):
+                results[index] = sent_media(msg)
+    return results
+
+async def deliver_batch(update, items, status_msg, user_id, chat_id):
+    """
+    Отправляет результат нескольких ссылок одним набором альбомов.
+    items - список (ссылка, ключ кэша, готовые file_id из кэша или DownloadJob)
+    """
+    message = update.message
+    entries = []  # (kind, file_id или путь)
+    owners = []   # (номер ссылки, путь файла или None для кэша)
+    failed = 0
+    too_large = []  # (ссылка, оценка размера), отклонённые проверкой перед скачиванием
+    cloud_items = set()
+    
+    for number, (url, cache_key, result) in enumerate(items):
+        if isinstance(result, list):
+            for item in result:
+                entries.append((item['kind'], item['file_id']))
+                owners.append((number, None))
+            continue
+        if result.rejected:
+            too_large.append((url, result.rejected))
+            continue
+        if not result.files:
+            failed += 1
+            continue
+        for file_path in result.files:
+            kind = media_kind(file_path)
+            if kind is None or not os.path.exists(file_path):
+                continue
+            path = choose_delivery(message.get_bot(), os.path.getsize(file_path), kind)
+            files = [file_path]
+            if path == 'split':
+                # Части большого файла идут в общий альбом вместо него самого
+                files = await prepare_parts(result, file_path, telegram_size_limit(message.get_bot()))
+                if not files:
+                    path = 'cloud'
+            if path not in ('telegram', 'split'):
+                if await send_cloud_link(message, result, file_path, user_id, chat_id):
+                    cloud_items.add(number)
+                continue
+            DELIVERY_PATHS.labels(path).inc()
+            for source in files:
+                sent = result.sent.get(source)
+                entries.append((kind, sent['file_id'] if sent else source))
+                owners.append((number, source))
+    
+    sent_items = []
+    if entries:
+        status_msg.update(f"📤 *Отправляю {len(entries)} файлов...*")
+        try:
+            sent_items = await send_media_groups(message, entries)
+        except Exception as e:
+            FAILURES.labels('telegram_send').inc()
+            logger.error(f"❌ Ошибка отправки альбома: {e}")
+            await message.reply_text(f"❌ Ошибка при отправке: {str(e)[:100]}")
+    
+    # file_id для повторов: в общее скачивание и в кэш результатов по каждой ссылке
+    per_item = {}
+    for (number, file_path), item in zip(owners, sent_items):
+        per_item.setdefault(number, []).append(item)
+        job = items[number][2]
+        if file_path and item:
+            job.sent[file_path] = item
+    
+    delivered = 0
+    for number, (url, cache_key, result) in enumerate(items):
+        sent = per_item.get(number, [])
+        if not sent and number not in cloud_items:
+            continue
+        delivered += 1
+        cacheable = not isinstance(result, list) and number not in cloud_items and sent and all(sent)
+        record_delivery(user_id, number in cloud_items, cache_key if cacheable else None, sent)
+    
+    await status_msg.delete()
+    if failed or delivered < len(items):
+        lines = [f"⚠️ *Готово {delivered} из {len(items)}*"]
+        if delivered + len(too_large) < len(items):
+            lines.append("Часть ссылок не удалось скачать или отправить")
+        if too_large:
+            lines.append("\n📦 *Слишком большие для Telegram:*")
+            lines += [f"• `{url}` — {size / (1024 * 1024):.1f} МБ" for url, size in too_large]
+            lines.append(too_large_reason())
+        await message.reply_text(
+            "\n".join(lines),
+            reply_markup=get_back_button(),
+            parse_mode='Markdown',
+            disable_web_page_preview=True
+        )
+
+async def handle_batch(update, urls, pref, status_msg):
+    """Несколько ссылок или плейлист: скачиваем параллельно, отправляем альбомами"""
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    
+    if await reject_if_overloaded(status_msg, user_id):
+        return
+    status_msg.update("📃 *Разбираю ссылки...*")
+    # Разбор плейлистов - тоже работа yt-dlp, поэтому в слоте пула
+    async with download_pool.slot(user_id):
+        urls = await expand_urls(urls)
+    total = len(urls)
+    done = 0
+    status_msg.update(f"📥 *Скачиваю {total} ссылок...*")
+    
+    acquired = []
+    
+    async def fetch(url):
+        nonlocal done
+        cache_key = result_cache.make_key(url, pref)
+        cached = result_cache.get(cache_key)
+        CACHE_LOOKUPS.labels('result', 'hit' if cached else 'miss').inc()
+        if cached:
+            result = cached
+        else:
+            async def download(job):
+                job.platform, job.mode = detect_platform(url), pref
+                # Проверка идёт уже в слоте: пробы yt-dlp тоже под лимитами пула
+                async with download_pool.slot(user_id) as reservation:
+                    info, est_bytes, plan = await preflight(job, update.get_bot(), url, pref)
+                    if job.rejected:
+                        return None, None
+                    download_pool.update_estimate(reservation, est_bytes)
+                    return await download_video(url, pref, known_info=info, plan=plan)
+            
+            result = await single_flight.acquire(cache_key, download)
+            acquired.append(result)
+        done += 1
+        status_msg.update(f"📥 *Скачано {done} из {total}...*")
+        return url, cache_key, result
+    
+    try:
+        items = await asyncio.gather(*(fetch(url) for url in urls))
+        await deliver_batch(update, items, status_msg, user_id, chat_id)
+    finally:
+        for job in acquired:
+            single_flight.release(job)
+
+async def handle_link(update, url, pref, status_msg):
+    """Одна ссылка: скачиваем (или ждём такое же скачивание) и отправляем"""
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    emoji = {'video': '🎥', 'audio': '🎵', 'all': '📦'}
+    cache_key = result_cache.make_key(url, pref)
+    
+    # Та же ссылка уже качается для другого пользователя - просто ждём её
+    joining = single_flight.in_progress(cache_key)
+    if joining:
+        CACHE_LOOKUPS.labels('single_flight', 'hit').inc()
+    
+    # Проверка и занятие слота идут без await между ними, поэтому лимит не обойти
+    if not joining and await reject_if_overloaded(status_msg, user_id):
+        return
+    
+    def show_position(position, eta):
+        status_msg.update(
+            f"⏳ *Ты в очереди: {position}*\n"
+            f"Примерное ожидание: {format_eta(eta)}"
+        )
+    
+    running = single_flight.get(cache_key)
+    if running and running.progress:
+        running.progress.watch(status_msg)
+    
+    async def download(job):
+        job.platform, job.mode = detect_platform(url), pref
+        job.progress = JobProgress(status_msg)
+        # Проверка идёт уже в слоте: пробы yt-dlp тоже под лимитами пула
+        async with download_pool.slot(user_id, on_position=show_position) as reservation:
+            status_msg.update(f"{emoji[pref]} *Скачиваю...*")
+            info, est_bytes, plan = await preflight(job, update.get_bot(), url, pref)
+            if job.rejected:
+                return None, None
+            download_pool.update_estimate(reservation, est_bytes)
+            return await download_video(url, pref, progress=job.progress, known_info=info, plan=plan)
+    
+    job = await single_flight.acquire(cache_key, download)
+    try:
+        await deliver_job(update, job, status_msg, user_id, chat_id, cache_key)
+    finally:
+        single_flight.release(job)
+
+async def process_links(update, urls, pref, status_msg):
+    """Скачивает и отправляет ссылки сообщения: в этом процессе или в воркере (BOT_ROLE=worker)"""
+    if len(urls) > 1 or is_playlist_url(urls[0]):
+        await handle_batch(update, urls, pref, status_msg)
+    else:
+        await handle_link(update, urls[0], pref, status_msg)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик всех сообщений"""
     user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
     text = update.message.text.strip()
     
-    if any(x in text.lower() for x in ['.com', '.ru', 'http', 'www', 'youtu', 'tiktok', 'instagram', 'facebook', 'twitter', 'x.com']):
+    # Telegram размечает и многие ссылки без схемы; что не размечено, extract_urls ищет сам
+    urls = [url for url in extract_urls(update.message) if classify_url(url)]
+    
+    if urls:
         pref = user_data.get_preference(user_id)
         emoji = {'video': '🎥', 'audio': '🎵', 'all': '📦'}
         
-        status_msg = await update.message.reply_text(
-            f"{emoji[pref]} *Скачиваю...*",
-            parse_mode='Markdown'
-        )
-        
-        files, temp_dir = await download_video(text, pref)
-        
-        if files and len(files) > 0:
-            user_data.add_download(user_id)
-            sent_count = 0
-            cloud_used = False
-            
-            for file_path in files:
+        if len(urls) == 1 and not is_playlist_url(urls[0]):
+            # Повторная ссылка: отвечаем готовыми file_id без скачивания
+            cache_key = result_cache.make_key(urls[0], pref)
+            cached = result_cache.get(cache_key)
+            CACHE_LOOKUPS.labels('result', 'hit' if cached else 'miss').inc()
+            if cached:
                 try:
-                    if not os.path.exists(file_path):
-                        logger.error(f"Файл не существует: {file_path}")
-                        continue
-                    
-                    file_size = os.path.getsize(file_path)
-                    logger.info(f"Файл: {file_path}, размер: {file_size} байт")
-                    
-                    if file_size <= MAX_TELEGRAM_SIZE:
-                        # Маленький файл - отправляем через Telegram
-                        if file_path.endswith('.mp4'):
-                            with open(file_path, 'rb') as f:
-                                await update.message.reply_video(
-                                    f,
-                                    supports_streaming=True,
-                                    caption="🎥 Видео готово!"
-                                )
-                            logger.info(f"✅ Видео отправлено через Telegram")
-                            sent_count += 1
-                            
-                        elif file_path.endswith('.mp3'):
-                            with open(file_path, 'rb') as f:
-                                await update.message.reply_audio(
-                                    f,
-                                    caption="🎵 Аудио готово!"
-                                )
-                            logger.info(f"✅ Аудио отправлено через Telegram")
-                            sent_count += 1
-                            
-                        elif file_path.endswith(('.jpg', '.jpeg', '.png', '.webp')):
-                            with open(file_path, 'rb') as f:
-                                await update.message.reply_photo(
-                                    f,
-                                    caption="📸 Обложка"
-                                )
-                            logger.info(f"✅ Фото отправлено через Telegram")
-                            sent_count += 1
-                    else:
-                        # Большой файл - загружаем на Яндекс.Диск
-                        if YANDEX_DISK_CLIENT:
-                            size_mb = file_size / (1024 * 1024)
-                            logger.info(f"📤 Файл большой ({size_mb:.1f} МБ), загружаю на Яндекс.Диск")
-                            
-                            public_url, delete_time = await upload_to_yandex(
-                                file_path, 
-                                user_id=user_id,
-                                chat_id=chat_id
-                            )
-                            
-                            if public_url:
-                                file_type = "Видео" if file_path.endswith('.mp4') else "Аудио" if file_path.endswith('.mp3') else "Файл"
-                                await update.message.reply_text(
-                                    f"📦 *{file_type} большой ({size_mb:.1f} МБ)*\n\n"
-                                    f"Telegram не может отправить файлы больше 50 МБ.\n"
-                                    f"🔗 [Скачать с Яндекс.Диска]({public_url})\n\n"
-                                    f"⏰ *Файл будет автоматически удален через 12 часов* (до {delete_time})",
-                                    parse_mode='Markdown',
-                                    disable_web_page_preview=True
-                                )
-                                logger.info(f"✅ Ссылка на Яндекс.Диск отправлена, удаление в {delete_time}")
-                                sent_count += 1
-                                cloud_used = True
-                            else:
-                                await update.message.reply_text(
-                                    f"❌ *Не удалось загрузить файл на Яндекс.Диск*\n"
-                                    f"Размер: {size_mb:.1f} МБ",
-                                    parse_mode='Markdown'
-                                )
-                        else:
-                            size_mb = file_size / (1024 * 1024)
-                            await update.message.reply_text(
-                                f"⚠️ *Файл слишком большой для Telegram ({size_mb:.1f} МБ)*\n\n"
-                                f"Яндекс.Диск не настроен. Добавьте токен для загрузки больших файлов.",
-                                parse_mode='Markdown'
-                            )
-                    
+                    await send_cached_result(update.message, cached)
+                    record_delivery(user_id)
+                    logger.info(f"♻️ Ответ из кэша (попаданий: {result_cache.hits}, промахов: {result_cache.misses})")
+                    return
                 except Exception as e:
-                    logger.error(f"❌ Ошибка отправки файла {file_path}: {e}")
-                    import traceback
-                    logger.error(traceback.format_exc())
-                    await update.message.reply_text(f"❌ Ошибка при отправке: {str(e)[:100]}")
-            
-            await status_msg.delete()
-            
-            if cloud_used:
-                user_data.add_download(user_id, via_cloud=True)
-            
-            if sent_count == 0:
-                await update.message.reply_text(
-                    "❌ *Не удалось отправить файлы*\n"
-                    "Проверьте логи для подробностей",
-                    reply_markup=get_back_button(),
-                    parse_mode='Markdown'
-                )
-            
-            # Очищаем временную папку
-            if temp_dir and os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                    logger.warning(f"Кэшированный file_id не подошёл, скачиваю заново: {e}")
+                    result_cache.pop(cache_key)
+        
+        status_msg = await StatusMessage.send(update.message, f"{emoji[pref]} *Скачиваю...*")
+        if BOT_ROLE == 'front':
+            await enqueue_links(update, urls, pref, status_msg)
         else:
-            await status_msg.edit_text(
-                "❌ *Не удалось скачать файлы*\n"
-                "Возможно, ссылка недействительна или видео защищено",
-                reply_markup=get_back_button(),
-                parse_mode='Markdown'
-            )
+            await process_links(update, urls, pref, status_msg)
+    
+    elif links:
+        # Ссылка, но не на ролик: отказываем сразу, без запуска yt-dlp
+        FAILURES.labels('unsupported_link').inc()
+        await update.message.reply_text(
+            "🚫 *Эта ссылка не поддерживается*\n\n"
+            "Я скачиваю видео с YouTube, TikTok, Instagram, Facebook и X, "
+            "а также прямые ссылки на медиафайлы",
+            reply_markup=get_back_button(),
+            parse_mode='Markdown'
+        )
     
     elif text.lower().startswith('/qr'):
         qr_text = text[3:].strip()
@@ -764,6 +3152,142 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
 
+# ===================== РОЛИ FRONT И WORKER =====================
+async def enqueue_links(update, urls, pref, status_msg):
+    """front: ставит ссылки сообщения в очередь заданий, скачают и отправят их воркеры"""
+    user_id = update.effective_user.id
+    admit_error, user_jobs = await asyncio.to_thread(job_queue.admission, user_id)
+    if admit_error:
+        await reject_admission(status_msg, admit_error, user_jobs)
+        return
+    payload = {
+        'update': update.to_dict(),
+        'status': status_msg.message.to_dict(),
+        'status_text': status_msg.text,
+        'urls': urls,
+        'pref': pref,
+    }
+    job_id = await asyncio.to_thread(job_queue.put, user_id, payload)
+    logger.info(f"📨 Задание {job_id} в очереди: ссылок {len(urls)}")
+
+async def collect_job_reports(bot):
+    """front: применяет отчёты воркеров (статистика, кэш результатов) и сообщает о потерянных заданиях"""
+    errors = 0
+    while True:
+        try:
+            finished = await asyncio.to_thread(job_queue.collect)
+            errors = 0
+        except Exception as e:
+            errors += 1
+            logger.error(f"❌ Ошибка чтения очереди заданий: {e}")
+            finished = []
+        for payload, state, report in finished:
+            # Отчёт уже удалён из очереди: ошибка в одном не должна терять остальные
+            try:
+                await apply_job_report(bot, payload, state, report)
+            except Exception as e:
+                logger.error(f"❌ Не удалось применить отчёт задания: {e}")
+        await asyncio.sleep(job_backoff(errors))
+
+async def apply_job_report(bot, payload, state, report):
+    """front: учитывает доставки из отчёта воркера, о потерянном задании сообщает пользователю"""
+    for record in report:
+        record_delivery(**record)
+    if state == 'lost':
+        FAILURES.labels('worker_lost').inc()
+        try:
+            await Message.de_json(payload['status'], bot).edit_text(
+                "❌ *Не удалось скачать файлы*\n"
+                "Воркер перестал отвечать, отправь ссылку снова",
+                reply_markup=get_back_button(),
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.debug(f"Статус потерянного задания не обновился: {e}")
+
+def job_backoff(errors):
+    """Пауза перед следующим опросом очереди: растёт при ошибках подряд, не больше JOB_LEASE / 3"""
+    return min(JOB_POLL_INTERVAL * 2 ** errors, JOB_LEASE / 3)
+
+async def run_queued_job(bot, job_id, payload, worker):
+    """worker: выполняет задание так же, как handle_message в одном процессе, и отчитывается front"""
+    update = Update.de_json(payload['update'], bot)
+    status_msg = StatusMessage(Message.de_json(payload['status'], bot), payload['status_text'])
+    # Задача получила свою копию контекста: отчёт виден только этому заданию
+    report = []
+    job_report.set(report)
+    ok = True
+    try:
+        await process_links(update, payload['urls'], payload['pref'], status_msg)
+    except Exception as e:
+        ok = False
+        FAILURES.labels('download').inc()
+        logger.error(f"❌ Задание {job_id} не выполнено: {e}")
+        try:
+            await status_msg.edit_text(
+                "❌ *Не удалось скачать файлы*\n"
+                "Попробуй отправить ссылку снова",
+                reply_markup=get_back_button(),
+                parse_mode='Markdown'
+            )
+        except Exception:
+            pass
+    # Неотмеченное задание после истечения аренды выдадут снова, поэтому повторяем
+    for attempt in range(3):
+        try:
+            await asyncio.to_thread(job_queue.finish, job_id, worker, report, ok)
+            return
+        except sqlite3.Error as e:
+            logger.error(f"❌ Не удалось завершить задание {job_id}: {e}")
+            await asyncio.sleep(job_backoff(attempt + 1))
+
+async def run_job_worker(bot):
+    """worker: берёт задания из очереди, не больше JOB_WORKER_SLOTS одновременно"""
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    running = {}  # задача -> id задания
+    last_heartbeat = time.monotonic()
+    logger.info(f"🧩 Воркер {worker} ждёт задания, слотов: {JOB_WORKER_SLOTS}")
+    errors = 0
+    try:
+        while True:
+            try:
+                if running and time.monotonic() - last_heartbeat >= JOB_LEASE / 3:
+                    await asyncio.to_thread(job_queue.heartbeat, worker)
+                    last_heartbeat = time.monotonic()
+                claimed = None
+                if len(running) < JOB_WORKER_SLOTS:
+                    claimed = await asyncio.to_thread(job_queue.claim, worker)
+                errors = 0
+            except Exception as e:
+                # База занята или недоступна: задания продолжают работать, опрос повторим позже
+                errors += 1
+                logger.error(f"❌ Ошибка очереди заданий: {e}")
+                await asyncio.sleep(job_backoff(errors))
+                continue
+            if claimed:
+                job_id, payload = claimed
+                task = asyncio.get_running_loop().create_task(run_queued_job(bot, job_id, payload, worker))
+                running[task] = job_id
+                task.add_done_callback(running.pop)
+                continue
+            # Очередь пуста или слоты заняты: ждём освободившийся слот или следующий опрос
+            if running:
+                await asyncio.wait(running, timeout=JOB_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+    finally:
+        # Остановка посреди заданий: отдаём их другим воркерам
+        job_ids, tasks = list(running.values()), list(running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if job_ids:
+            try:
+                job_queue.release(job_ids, worker)
+                logger.info(f"↩️ Заданий возвращено в очередь: {len(job_ids)}")
+            except sqlite3.Error as e:
+                logger.error(f"❌ Задания не вернулись в очередь, их выдадут после аренды: {e}")
+
 # ===================== ОБРАБОТЧИК КНОПОК =====================
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
@@ -834,16 +3358,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         qr_text = data[3:]
         await query.edit_message_text("🔄 *Создаю QR-код...*", parse_mode='Markdown')
         
-        path = make_qr(qr_text)
-        if path:
-            with open(path, 'rb') as photo:
-                await query.message.reply_photo(
-                    photo=photo,
-                    caption=f"✅ *QR-код готов!*",
-                    reply_markup=get_back_button(),
-                    parse_mode='Markdown'
-                )
-            os.unlink(path)
+        if await send_qr(query.message, qr_text):
             await query.delete_message()
             user_data.add_qr(user_id)
         else:
@@ -863,6 +3378,176 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 # ===================== ЗАПУСК БОТА =====================
+background_tasks = set()
+
+def start_background_task(coro, critical=False):
+    """Запускает долгоживущую фоновую задачу и держит на неё ссылку.
+    Падение задачи пишется в лог; без критичной задачи (очередь заданий, удаление файлов)
+    процесс бесполезен, поэтому он завершается и его перезапускает супервизор"""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    
+    def on_done(task):
+        background_tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error(f"❌ Фоновая задача {task.get_coro().__qualname__} упала", exc_info=task.exception())
+        if critical:
+            logger.critical("🛑 Критичная фоновая задача остановилась, завершаем процесс")
+            os.kill(os.getpid(), signal.SIGTERM)
+    
+    task.add_done_callback(on_done)
+    return task
+
+def warm_up_imports():
+    """Импортирует тяжёлые модули заранее, в фоне, чтобы первый запрос их не ждал"""
+    import qrcode  # noqa: F401
+    import requests  # noqa: F401
+
+async def open_storage():
+    """
+    Открывает базы и читает файлы с диска в фоновых потоках: при импорте модуля
+    ничего не создаётся и не переносится (миграция yandex_files.json бывает долгой)
+    """
+    global file_manager, job_queue
+    init_ytdlp_options()
+    
+    async def open_job_queue():
+        return await asyncio.to_thread(JobQueue, JOB_QUEUE_DB) if BOT_ROLE != 'all' else None
+    
+    loads = []
+    if BOT_ROLE != 'worker':
+        # Воркер не читает статистику и кэш результатов: доставки уходят front в отчётах
+        loads = [asyncio.to_thread(user_data.load_data), asyncio.to_thread(result_cache.load_data)]
+    file_manager, job_queue, *_ = await asyncio.gather(asyncio.to_thread(FileManager), open_job_queue(), *loads)
+    if BOT_ROLE == 'front':
+        QUEUE_DEPTH.set_function(job_queue.depth)
+
+async def on_startup(app):
+    """Открывает базы и запускает фоновые задачи после старта приложения"""
+    await open_storage()
+    start_background_task(loop_lag_monitor.run())
+    start_background_task(user_data.run_flusher())
+    start_background_task(result_cache.run_flusher())
+    start_background_task(connect_yandex(), critical=True)
+    start_background_task(temp_space.run_reclaimer())
+    start_background_task(asyncio.to_thread(warm_up_imports))
+    if BOT_ROLE == 'front':
+        # Front не качает сам: процессы yt-dlp не нужны
+        start_background_task(collect_job_reports(app.bot), critical=True)
+    else:
+        start_background_task(ytdlp_processes.prestart(YTDLP_PROFILES.values()))
+    if BOT_ROLE == 'worker':
+        start_background_task(run_job_worker(app.bot), critical=True)
+
+async def on_shutdown(app):
+    """Останавливает фоновые задачи перед выходом"""
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await ytdlp_processes.close()
+    await asyncio.gather(user_data.flush(), result_cache.flush())
+
+def make_web_app(app):
+    """Приложение tornado с вебхуком и /metrics (tornado нужен только в режиме вебхука)"""
+    import tornado.web
+    
+    class WebhookHandler(tornado.web.RequestHandler):
+        """Принимает апдейты Telegram и кладёт их в очередь приложения"""
+        
+        async def post(self):
+            if WEBHOOK_SECRET and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                raise tornado.web.HTTPError(403)
+            try:
+                update = Update.de_json(json.loads(self.request.body), app.bot)
+            except (ValueError, TypeError):
+                raise tornado.web.HTTPError(400)
+            await app.update_queue.put(update)
+    
+    class MetricsHandler(tornado.web.RequestHandler):
+        """Отдаёт метрики в формате Prometheus"""
+        
+        async def get(self):
+            self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+            # Сбор обходит временные папки и считает очередь в SQLite: не в event loop
+            self.write(await asyncio.to_thread(generate_latest))
+    
+    return tornado.web.Application([
+        (r"/webhook", WebhookHandler),
+        (r"/metrics", MetricsHandler),
+    ])
+
+async def serve_webhook(app, port, webhook_url):
+    """Вебхук и /metrics на одном порту"""
+    import tornado.httpserver
+    
+    web_app = make_web_app(app)
+    server = tornado.httpserver.HTTPServer(web_app)
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    # run_webhook не даёт добавить свои пути, поэтому жизненный цикл ведём сами
+    async with app:
+        await on_startup(app)
+        await app.bot.set_webhook(webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET)
+        await app.start()
+        server.listen(port, address="0.0.0.0")
+        try:
+            await stop.wait()
+        finally:
+            server.stop()
+            await app.stop()
+            await on_shutdown(app)
+
+async def serve_worker(app):
+    """BOT_ROLE=worker: апдейты не принимаются, только задания из очереди"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    async with app:
+        await on_startup(app)
+        try:
+            await stop.wait()
+        finally:
+            await on_shutdown(app)
+
+def build_application(builder=None):
+    """Собирает приложение со всеми обработчиками (builder можно передать свой, например в бенчмарке)"""
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+        if TELEGRAM_API_URL:
+            builder = (
+                builder
+                .base_url(TELEGRAM_API_URL)
+                .base_file_url(TELEGRAM_FILE_URL or TELEGRAM_API_URL.replace('/bot', '/file/bot', 1))
+                .local_mode(TELEGRAM_LOCAL_MODE)
+                .read_timeout(LOCAL_API_READ_TIMEOUT)
+            )
+    # Апдейты обрабатываются параллельно: меню и QR не ждут чужих скачиваний
+    app = (
+        builder
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("qr", qr_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    # Ссылки обрабатываются вне лимита CONCURRENT_UPDATES (block=False): скачивание
+    # держит обработчик минутами, и иначе 64 ждущих скачивания заняли бы все места
+    # для /start, кнопок и QR. Сколько ссылок ждёт, ограничивают MAX_QUEUE и пул
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
+    app.add_handler(CallbackQueryHandler(button_handler))
+    return app
+
 def main():
     """Запуск бота"""
     print("⚡ Запуск HartiDash с Яндекс.Диском...")
@@ -872,33 +3557,32 @@ def main():
     else:
         print("⚠️ Файл cookies.txt не найден. YouTube может работать нестабильно")
     
-    if YANDEX_DISK_CLIENT:
-        print("✅ Яндекс.Диск настроен, автоудаление через 12ч активно")
+    if YANDEX_DISK_TOKEN:
+        print("✅ Яндекс.Диск настроен (токен проверится после запуска), автоудаление через 12ч активно")
     else:
         print("⚠️ Яндекс.Диск не настроен. Большие файлы не будут загружаться")
     
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = build_application()
     
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("qr", qr_command))
-    app.add_handler(CommandHandler("stats", stats_command))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(CallbackQueryHandler(button_handler))
+    if BOT_ROLE == 'worker':
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT, addr=METRICS_ADDR)
+            print(f"📈 Метрики на http://{METRICS_ADDR}:{METRICS_PORT}/metrics")
+        print(f"🧩 Запуск воркера: задания из {JOB_QUEUE_DB}")
+        asyncio.run(serve_worker(app))
+        return
     
     port = int(os.environ.get('PORT', 8080))
     railway_url = os.environ.get('RAILWAY_STATIC_URL')
     
     if railway_url:
         webhook_url = f"https://{railway_url}/webhook"
-        print(f"🌐 Устанавливаем вебхук на {webhook_url}")
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            url_path="webhook",
-            webhook_url=webhook_url
-        )
+        print(f"🌐 Устанавливаем вебхук на {webhook_url}, метрики на /metrics")
+        asyncio.run(serve_webhook(app, port, webhook_url))
     else:
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT, addr=METRICS_ADDR)
+            print(f"📈 Метрики на http://{METRICS_ADDR}:{METRICS_PORT}/metrics")
         print("🔄 Запуск в режиме polling...")
         app.run_polling(allowed_updates=Update.ALL_TYPES)
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Процесс-воркер yt-dlp для бота HartiDash.
+
+Бот держит пул таких процессов (YtdlpProcessPool в bot.py), чтобы разбор
+страниц, расшифровка подписей и скачивание не делили GIL с event loop.
+Протокол - JSON по строке на сообщение:
+
+    stdin:  {"id": 1, "action": "download" | "extract" | "probe" | "warm", "url": "...", "opts": {...},
+             "info": info из прошлого probe или null}
+    stdout: {"id": 1, "event": "progress" | "postprocessor", "data": {...}}
+            {"id": 1, "event": "done", "result": info или null}
+            {"id": 1, "event": "error", "error": "текст ошибки"}
+
+Если передан info, страница заново не разбирается: yt-dlp выбирает формат
+и скачивает по готовым метаданным (как --load-info-json).
+
+Экземпляры YoutubeDL не создаются на каждую задачу: воркер держит по одному
+на профиль опций (всё, кроме JOB_OPTS), с уже загруженными экстракторами,
+cookies и открытыми HTTP-соединениями; warm только создаёт экземпляр заранее.
+Экземпляры никогда не закрываются, поэтому yt-dlp не перезаписывает общий
+cookies.txt.
+
+Задачи выполняются по одной. Отмена и таймаут - это завершение процесса
+со стороны бота, после чего он запускает новый.
+"""
+
+import json
+import os
+import sys
+import time
+
+import yt_dlp
+
+PROGRESS_INTERVAL = 0.25  # секунд между сообщениями о ходе скачивания; хук yt-dlp зовётся на каждый кусок
+JOB_OPTS = ('outtmpl', 'format', 'merge_output_format')  # опции, которые меняются от задачи к задаче
+
+_protocol = None  # копия stdout для протокола, см. main
+_instances = {}  # профиль опций -> YoutubeDL
+_current = {'id': None, 'last_progress': 0.0}  # задача, которой отдаются хуки
+
+
+def send(message):
+    _protocol.write(json.dumps(message, ensure_ascii=False, default=str) + '\n')
+    _protocol.flush()
+
+
+def plain(d):
+    """Только простые значения из словаря хука: info_dict и прочее не нужны боту"""
+    return {k: v for k, v in d.items() if isinstance(v, (str, int, float, bool, type(None)))}
+
+
+def progress_hook(d):
+    now = time.monotonic()
+    if d.get('status') == 'downloading' and now - _current['last_progress'] < PROGRESS_INTERVAL:
+        return
+    _current['last_progress'] = now
+    send({'id': _current['id'], 'event': 'progress', 'data': plain(d)})
+
+
+def postprocessor_hook(d):
+    send({'id': _current['id'], 'event': 'postprocessor', 'data': plain(d)})
+
+
+def checkout(opts):
+    """Готовый YoutubeDL для профиля opts с опциями задачи из JOB_OPTS"""
+    profile = {k: v for k, v in opts.items() if k not in JOB_OPTS}
+    key = json.dumps(profile, sort_keys=True)
+    ydl = _instances.get(key)
+    if ydl is None:
+        profile['progress_hooks'] = [progress_hook]
+        profile['postprocessor_hooks'] = [postprocessor_hook]
+        ydl = _instances[key] = yt_dlp.YoutubeDL(profile)
+
+    ydl.params['outtmpl'] = {'default': opts['outtmpl']} if opts.get('outtmpl') else {}
+    ydl._parse_outtmpl()
+    ydl.params['merge_output_format'] = opts.get('merge_output_format')
+    fmt = opts.get('format')
+    if fmt != ydl.params.get('format'):
+        # Селектор формата строится из строки один раз, как в конструкторе YoutubeDL
+        ydl.params['format'] = fmt
+        ydl.format_selector = ydl.build_format_selector(fmt) if fmt else None
+    return ydl
+
+
+def run(request):
+    _current['id'] = request['id']
+    _current['last_progress'] = 0.0
+    ydl = checkout(request['opts'])
+    if request['action'] == 'warm':
+        return None
+    # probe - только метаданные, без скачивания (плейлисты, проверка перед скачиванием)
+    download = request['action'] != 'probe'
+    if request.get('info'):
+        info = ydl.process_ie_result(request['info'], download=download)
+    elif request['action'] == 'download':
+        ydl.download([request['url']])
+        return None
+    else:
+        info = ydl.extract_info(request['url'], download=download)
+    return None if request['action'] == 'download' else ydl.sanitize_info(info)
+
+
+def main():
+    global _protocol
+    # Протокол идёт через собственную копию stdout, а всё, что печатают yt-dlp и
+    # ffmpeg, уходит в stderr и не ломает строки протокола
+    _protocol = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    send({'id': None, 'event': 'ready'})
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            send({'id': request['id'], 'event': 'done', 'result': run(request)})
+        except Exception as e:
+            send({'id': request['id'], 'event': 'error', 'error': str(e)})
+
+
+if __name__ == '__main__':
+    main()